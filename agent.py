@@ -1,4 +1,3 @@
-import copy
 import os
 import re
 import sys
@@ -7,7 +6,7 @@ import time
 import asyncio
 import tempfile
 import traceback
-import subprocess
+from uuid import uuid4
 from pathlib import Path
 from abc import abstractmethod
 from dataclasses import dataclass
@@ -17,9 +16,10 @@ from typing import AsyncGenerator, Union, Dict, Tuple, List, Callable
 from model import LLM
 from monitor import Monitor, SubTask
 from log import AgentLogger, LogLevel
+from kernel import PythonKernel
 from memory_manager import MemoryManager
-from tool import generate_tool_schema, ToolRegistry, generate_tool_des
-from utils import extract_json_codeblock, create_message, deep_update, pretty_print_trajectory, safe_json_parse
+from tool import generate_tool_schema, ToolRegistry, generate_tool_des, current_agent_key, current_agent_options
+from utils import extract_json_codeblock, create_message, deep_update, pretty_print_trajectory, safe_json_parse, stream_subprocess, HeadTailBuffer, Trajectory, Message
 from prompt.system_prompt import MUSE_list_fact_prompt, MUSE_plan_subtasks_prompt, \
     MUSE_execute_subtask_prompt, MUSE_action_with_observation__instruction_prompt, task_final_plan_prompt, \
     task_replan_for_success_prompt, task_replan_for_failure_prompt, MUSE_execute_subtask_access_guide_prompt
@@ -53,6 +53,31 @@ class ToolResultFormatValidator(BaseModel):
 
     data: str = Field(..., description="Tool execution results")
     instruction: str = Field(..., description="Instruction for LLMs bundled with the tool")
+    progress: bool = Field(False, description="Intermediate output shown to the operator only, not part of the tool result")
+    metrics: Dict[str, float] = Field(default_factory=dict, description="Numeric measurements accumulated into the monitor, e.g. settle_wait_seconds")
+
+class _BrowserGuard:
+    """
+    并行反思中单个检查步骤对浏览器的独占权: 步骤第一次调用浏览器工具时获得共享锁, 直到该步骤结束才释放。
+    所有检查步骤共用智能体的同一个浏览器 (页面、登录态), 使用浏览器的步骤因此整体串行, 其他步骤仍可并行。
+    """
+
+    def __init__(self, lock: asyncio.Lock):
+        self.lock = lock
+        self.owned = False
+
+    async def claim(self) -> bool:
+        """获取独占权, 返回是否为新获得 (此前其他步骤可能改变了页面)。"""
+        if self.owned:
+            return False
+        await self.lock.acquire()
+        self.owned = True
+        return True
+
+    def release(self):
+        if self.owned:
+            self.owned = False
+            self.lock.release()
 
 class BaseAgent:
     """智能体的抽象基类, 提供通用的初始化与执行流程。"""
@@ -63,7 +88,9 @@ class BaseAgent:
             sys_prompt_template: str,
             output_dir: str="outputs",
             agent_name: str="default_agent",
-            task_name: str="default_task"
+            task_name: str="default_task",
+            persistent_python: bool = False,
+            observation_token_budget: int = None
     ):
         # ----------- 基础运行参数 -----------
         self.subtask_action_limit = None
@@ -74,8 +101,10 @@ class BaseAgent:
         self.agent_name: str = agent_name
         self.task_name: str = task_name
         self.output_dir: Path = Path(output_dir)
-        self.llm = LLM(init_model_name)
+        self.llm = LLM.get(init_model_name)
         self.monitor = Monitor()
+        # 智能体实例的唯一标识, 运行期间写入 current_agent_key, 供浏览器池等有状态工具区分不同智能体。
+        self.agent_key: str = f"{agent_name}/{task_name}/{uuid4().hex[:8]}"
 
         # 工具注册表, 会动态加载 toolbox 目录中的所有工具。
         self.tool_registrar = ToolRegistry()
@@ -84,6 +113,12 @@ class BaseAgent:
         self.history = []
         self.sys_prompt_template = sys_prompt_template
 
+        # 可选的常驻 Python 内核: 开启后 python 工具在同一个 worker 中执行, 跨动作保留 import 与变量。
+        self.python_kernel: PythonKernel | None = PythonKernel() if persistent_python else None
+
+        # 传给有状态工具的按智能体选项: observation_token_budget 限制该智能体浏览器的可访问性树观测大小, None 使用 config.yaml 的默认值。
+        self.tool_options: dict = {"observation_token_budget": observation_token_budget}
+
     def render_tool_schema_texts(self) -> str:
         """将所有工具的 JSON Schema 拼装为文本, 提供给 LLM 参考。"""
         tool_schemas = []
@@ -98,7 +133,7 @@ class BaseAgent:
         """返回当前任务的输出目录路径。"""
         return self.output_dir / self.agent_name / self.task_name
 
-    def save_history(self, trajectory: List[dict]):
+    def save_history(self, trajectory: List[Message]):
         """将任务执行轨迹保存到磁盘, 方便复盘。"""
         try:
             output_path = self._get_output_dir() / "history.txt"
@@ -113,15 +148,20 @@ class BaseAgent:
             traceback.print_exc()
 
     @staticmethod
-    def python_interpreter(code: str, work_dir: str = "/workspace") -> str:
-        """在隔离的临时文件中执行传入的 Python 代码。"""
+    async def python_interpreter(code: str, work_dir: str = "/workspace") -> AsyncGenerator[dict, None]:
+        """
+        在隔离的临时文件中执行传入的 Python 代码, 子进程以异步方式运行, 不阻塞事件循环。
+        与其他工具相同, 以 {"data", "instruction"} 协议产出: 逐行输出作为 progress 分片实时展示, 最后一个分片为完整结果。
+        """
         STATUS_EXECUTED = "CODE_EXECUTED"
         STATUS_FAILURE_TIMEOUT = "TOOL_FAILURE_TIMEOUT"
         STATUS_FAILURE_EXCEPTION = "TOOL_FAILURE_UNKNOWN_EXCEPTION"
 
         timeout = 270
+        max_output_length = 65536
         result = {}
         script_path = None
+        outputs = {"stdout": HeadTailBuffer(max_output_length), "stderr": HeadTailBuffer(max_output_length)}
 
         try:
             # 将代码写入临时文件, 避免直接执行用户输入带来的安全隐患。
@@ -129,25 +169,32 @@ class BaseAgent:
                 f.write(code)
                 script_path = f.name
 
-            # 通过子进程执行临时脚本, 捕获标准输出与错误输出。
-            proc = subprocess.run(
-                [sys.executable, script_path],
-                capture_output=True, text=True, timeout=timeout, cwd=work_dir, encoding='utf-8', errors='replace'
-            )
+            # 通过子进程 (-u 关闭输出缓冲) 执行临时脚本, 逐行转发标准输出与错误输出; 超时会杀死整个进程组。
+            returncode = None
+            async for name, line in stream_subprocess([sys.executable, "-u", script_path], timeout=timeout, cwd=work_dir):
+                if name == "returncode":
+                    returncode = line
+                    continue
+                outputs[name].append(line)
+                yield {"data": line, "instruction": "", "progress": True}
 
             result = {
                 "execution_status": STATUS_EXECUTED,
                 "code_result": {
-                    "returncode": proc.returncode
+                    "returncode": returncode,
+                    "stdout_truncated": outputs["stdout"].truncated,
+                    "stderr_truncated": outputs["stderr"].truncated
                 },
-                "stdout": proc.stdout.strip(),
-                "stderr": proc.stderr.strip()
+                "stdout": outputs["stdout"].getvalue().strip(),
+                "stderr": outputs["stderr"].getvalue().strip()
             }
 
-        except subprocess.TimeoutExpired:
+        except asyncio.TimeoutError:
             result = {
                 "execution_status": STATUS_FAILURE_TIMEOUT,
-                "stderr": f"Code execution timed out (terminated after {timeout} seconds)."
+                "stdout": outputs["stdout"].getvalue().strip(),
+                "stderr": (outputs["stderr"].getvalue().strip() + "\n"
+                           f"Code execution timed out (terminated after {timeout} seconds).").strip()
             }
 
         except Exception:
@@ -163,7 +210,13 @@ class BaseAgent:
                 except Exception:
                     pass
 
-        return json.dumps(result, ensure_ascii=False, indent=2)
+        yield {"data": json.dumps(result, ensure_ascii=False, indent=2), "instruction": ""}
+
+    def run_python(self, code: str) -> AsyncGenerator[dict, None]:
+        """python 工具入口: 开启常驻内核时在 worker 中执行, 否则沿用一次性子进程模式。"""
+        if self.python_kernel is not None:
+            return self.python_kernel.run(code)
+        return self.python_interpreter(code)
 
     async def call_tool(
         self,
@@ -173,19 +226,24 @@ class BaseAgent:
         """统一处理工具调用, 并以流式方式返回工具输出。"""
         tool_result = ""
         if tool_name == "python":
-            # Python 工具特殊处理: 直接调用上面的 python_interpreter。
-            result = self.python_interpreter(arguments["code"])
-            yield "[STREAMING]", result
-            tool_result = result
+            # Python 工具特殊处理: 直接调用 run_python, progress 分片只用于展示。
+            async for tool_chunk in self.run_python(arguments["code"]):
+                yield "[STREAMING]", tool_chunk["data"]
+                if not tool_chunk.get("progress", False):
+                    tool_result += tool_chunk["data"]
         else:
             tool_function = self.tool_registrar.get_tool(tool_name)
             if tool_function:
                 try:
                     async for tool_chunk in tool_function(**arguments):
                         ToolResultFormatValidator.model_validate(tool_chunk)
+                        if tool_chunk.get("metrics"):
+                            self.monitor.add_tool_metrics(tool_name, tool_chunk["metrics"])
 
                         chunk = tool_chunk["data"]
                         yield "[STREAMING]", chunk
+                        if tool_chunk.get("progress", False):
+                            continue
 
                         tool_result += chunk
                     self.monitor.inc_tool_call(tool_name)
@@ -235,10 +293,10 @@ class BaseAgent:
 
         return ToolCallParseResult(False, None, "No tool_call or python code found in the output.")
 
-    async def _in_context_step(self, prompt: str):
+    async def _in_context_step(self, prompt: str, call_site: str = "in_context"):
         """与 LLM 进行单轮对话, 并将问答记录写入历史。"""
         ai_response = ""
-        async for chunk in self.llm.async_stream_generate(prompt, history=self.history):
+        async for chunk in self.llm.async_stream_generate(prompt, history=self.history, call_site=call_site):
             ai_response += chunk
             yield chunk
         self.history.extend([
@@ -254,14 +312,14 @@ class BaseAgent:
     async def single_turn_chat(self, prompt: str, llm_name: str = None) -> None:
         """暴露给外部的单轮问答接口, 支持临时切换 LLM。"""
         if llm_name is not None:
-            self.llm = LLM(llm_name)
+            self.llm = LLM.get(llm_name)
         async for chunk in self._in_context_step(prompt):
             print(chunk)
 
     async def run(self, prompt: str, llm_name: str=None, subtask_action_limit: int=None, num_actions_scale: float=None, subtasks_limit: int=None, time_limit: int=None, verbose: bool=True) -> None:
         """Agent 对外的统一入口, 负责设置预算并调用子类实现的 _run。"""
         if llm_name is not None:
-            self.llm = LLM(llm_name)
+            self.llm = LLM.get(llm_name)
 
         if subtask_action_limit is not None:
             self.subtask_action_limit = subtask_action_limit
@@ -272,15 +330,25 @@ class BaseAgent:
         if time_limit is not None:
             self.num_time_limit = time_limit
 
-        async for chunk in self._run(prompt):
-            if verbose:
-                print(chunk, end="", flush=True)
-            else:
-                if len(chunk) > 1000:
-                    display = chunk[:200] + "\n...The content is too long and has been omitted...\n" + chunk[-200:]
+        token = current_agent_key.set(self.agent_key)
+        options_token = current_agent_options.set(self.tool_options)
+        try:
+            async for chunk in self._run(prompt):
+                if verbose:
+                    print(chunk, end="", flush=True)
                 else:
-                    display = chunk
-                print(display, end="", flush=True)
+                    if len(chunk) > 1000:
+                        display = chunk[:200] + "\n...The content is too long and has been omitted...\n" + chunk[-200:]
+                    else:
+                        display = chunk
+                    print(display, end="", flush=True)
+        finally:
+            # 任务结束 (包括异常退出、超时取消) 时归还浏览器等按智能体分配的工具资源, 并关闭常驻 Python worker
+            await self.tool_registrar.release_resources(self.agent_key)
+            if self.python_kernel is not None:
+                await self.python_kernel.shutdown()
+            current_agent_options.reset(options_token)
+            current_agent_key.reset(token)
 
 
 class MUSE(BaseAgent):
@@ -300,9 +368,13 @@ class MUSE(BaseAgent):
             update_memory: bool = True,
             env_feedback_func: Callable[..., str]=None,
             env_feedback_args: dict=None,
-            lang="en"
+            lang="en",
+            persistent_python: bool = False,
+            memory_retrieval_top_k: int = None,
+            reflect_workers: int = 1,
+            observation_token_budget: int = None
     ):
-        super().__init__(init_model_name, sys_prompt_template, output_dir, agent_name, task_name)
+        super().__init__(init_model_name, sys_prompt_template, output_dir, agent_name, task_name, persistent_python, observation_token_budget)
         self.mode = mode_label
         self.task_round = task_round
 
@@ -311,7 +383,8 @@ class MUSE(BaseAgent):
 
         # 初始化记忆管理器, 会加载历史记忆并同步到对话历史中。
         tool_schema_texts = self.render_tool_schema_texts()
-        self.memory_manager = MemoryManager(memory_dir, self.logger, self._get_output_dir(), sys_prompt_template, tool_schema_texts, use_memory)
+        # memory_retrieval_top_k 不为 None 时, 系统提示词只包含与当前任务/子任务最相关的 top-k 条应用指南。
+        self.memory_manager = MemoryManager(memory_dir, self.logger, self._get_output_dir(), sys_prompt_template, tool_schema_texts, use_memory, memory_retrieval_top_k)
         self.history = self.memory_manager.get_history()
 
         if (env_feedback_func is None) != (env_feedback_args is None):
@@ -320,6 +393,8 @@ class MUSE(BaseAgent):
         self.env_feedback_args = env_feedback_args
 
         self.language_prompt = "\n请以中文输出" if lang=="zh" else ""
+        # 反思阶段同时运行的检查步骤数, 1 为原有的顺序执行。
+        self.reflect_workers = max(1, reflect_workers)
 
         self.to_do_subtasks: List[SubTask] = []
 
@@ -329,11 +404,13 @@ class MUSE(BaseAgent):
         # The context analysis is based on the data stored in the agent.history property.
 
         st_time = time.time()
+        self.memory_manager.set_retrieval_query(task)
+        self.memory_manager.update_system_prompt()
         # plan
         plan_trajectory = []
         async for chunk in self.initial_plan(task, plan_trajectory):
             yield chunk
-        self.logger.log_task(self.history[-1]["content"][0]["text"], "PLANNING···", "Multi-step Subtasks Plan")
+        self.logger.log_task(self.history[-1].text, "PLANNING···", "Multi-step Subtasks Plan")
         # The plan trajectory includes three messages:
         #   system message,
         #   user message-> content is the `task`,
@@ -346,6 +423,7 @@ class MUSE(BaseAgent):
             cur_subtask = self.to_do_subtasks.pop(0)
             cur_subtask.set_index(self.monitor.subtasks_used + 1)
             cur_subtask_prompt = f"SubTask{cur_subtask.index}: {cur_subtask.name}\nGoal: {cur_subtask.goal}"
+            self.memory_manager.set_retrieval_query(f"{task}\n{cur_subtask_prompt}")
             self.logger.log_task(cur_subtask_prompt, subtitle=f"EXECUTING···", title=f"Execute Subtask")
 
             subtask_retry_time_limit = 2
@@ -377,9 +455,11 @@ class MUSE(BaseAgent):
             # record done sub-task
             self.monitor.add_done_subtask(cur_subtask)
             # add trajectory into main history
-            add_trajectory = copy.deepcopy(cur_subtask.trajectory)
+            # trim_traj 以新消息替换被裁剪的条目, 浅拷贝即可保护 cur_subtask.trajectory
+            add_trajectory = list(cur_subtask.trajectory)
             self.memory_manager.trim_traj(add_trajectory)
             self.memory_manager.add_traj(add_trajectory)
+            await self.memory_manager.compact_history()
 
             if self.is_limit_exceeded(action_used=self.monitor.num_actions, subtasks_used=self.monitor.subtasks_used, time_used=time.time() - st_time):
                 break
@@ -393,11 +473,11 @@ class MUSE(BaseAgent):
             else:
                 async for chunk in self.replan(task_final_plan_prompt, task):
                     yield chunk
-            self.logger.log_task(self.history[-1]["content"][0]["text"], "RE-PLANNING···",
+            self.logger.log_task(self.history[-1].text, "RE-PLANNING···",
                                  "Multi-Step Subtasks Re-Plan")
 
             # self.memory_manager.rm_traj_by_length(len(add_trajectory) - 1, 5)
-            # self.history[-1]["content"][0]["text"] = "[SYSTEM INFO: History subtask tracks removed for brevity]\n" + self.history[-5]["content"][0]["text"]
+            # self.history[-1] = create_message("assistant", "[SYSTEM INFO: History subtask tracks removed for brevity]\n" + self.history[-5].text)
 
         if not self.to_do_subtasks and self.monitor.done_subtasks[-1].finish:
             self.logger.log_task(f"Agent finish all the subtasks.\nTotal action steps: {self.monitor.num_actions}.", subtitle="DONE", title="Task Finished")
@@ -414,7 +494,7 @@ class MUSE(BaseAgent):
         self.memory_manager.save_run_artifacts(self.monitor)
         return
 
-    async def initial_plan(self, task: str, plan_trajectory: List[dict]):
+    async def initial_plan(self, task: str, plan_trajectory: List[Message]):
         """调用多步规划能力, 生成初始子任务列表并记录轨迹。"""
         user_prompt = f"<task>\n{task}\n</task>"
         async for chunk in self._multi_step_plan(user_prompt):
@@ -425,7 +505,7 @@ class MUSE(BaseAgent):
             self,
             prompt: str,
             action_limit: int = None,
-            subtask_trajectory: List[dict] = None,
+            subtask_trajectory: List[Message] = None,
             subtask_name: str = "",
             temperature: float = 1.0,
             need_guide: bool = True
@@ -434,19 +514,20 @@ class MUSE(BaseAgent):
         Determine if the LLM output contains tool execution requirements.
         If so, execute the tool. This process repeats until the LLM output no longer contains tool execution requirements.
         """
-        # 为防止直接修改原始轨迹, 这里使用副本进行操作。
-        working_trajectory = copy.deepcopy(subtask_trajectory)
+        # working_trajectory 与原始轨迹共享消息对象, trim_traj 只在 working_trajectory 中替换被裁剪的条目,
+        # 原始轨迹保持完整且无需复制。
+        working_trajectory = Trajectory(subtask_trajectory)
         def _append_turn(user_text: str, ai_text: str):
-            subtask_trajectory.extend([
-                create_message("user", user_text),
-                create_message("assistant", ai_text)
-            ])
-            working_trajectory.extend([
-                create_message("user", user_text),
-                create_message("assistant", ai_text)
-            ])
+            turn = [create_message("user", user_text), create_message("assistant", ai_text)]
+            subtask_trajectory.extend(turn)
+            working_trajectory.extend(turn)
 
         start_index = len(subtask_trajectory)
+        # 新的 ReAct 循环: 之前的完整可访问性树已被裁剪出上下文, 第一次观测必须是完整树而不是 diff
+        await self.tool_registrar.reset_observations(current_agent_key.get())
+        if self.python_kernel is not None:
+            # 每个子任务从干净的命名空间开始, 但保留 worker 中已导入的模块。
+            await self.python_kernel.reset()
         if need_guide:
             cur_prompt = MUSE_execute_subtask_prompt.format(subtask=prompt) + MUSE_execute_subtask_access_guide_prompt + self.language_prompt
         else:
@@ -455,12 +536,12 @@ class MUSE(BaseAgent):
         actions = 0
         while exist_tool_call and (action_limit is None or actions < action_limit):
             self.memory_manager.update_system_prompt()
-            self.memory_manager.trim_traj(working_trajectory, preserve_last=3)
+            self.memory_manager.trim_traj(working_trajectory, preserve_last=3, checkpoint=self.memory_manager.trim_checkpoint)
 
             ai_response = ""
             async for chunk in self.llm.async_stream_generate(
                     cur_prompt if actions == 0 else MUSE_action_with_observation__instruction_prompt.format(observation=cur_prompt) + self.language_prompt,
-                    history=self.history + working_trajectory, temperature=temperature
+                    history=self.history + working_trajectory, temperature=temperature, call_site="react_step"
             ):
                 yield chunk
                 ai_response += chunk
@@ -525,7 +606,7 @@ class MUSE(BaseAgent):
             trajectory=pretty_print_trajectory(cur_subtask.trajectory, True, False)
         )
         check_list_str = ""
-        async for chunk in self.llm.async_stream_generate(plan_prompt + reflect_plan__instruction_prompt + self.language_prompt, history=reflect_history):
+        async for chunk in self.llm.async_stream_generate(plan_prompt + reflect_plan__instruction_prompt + self.language_prompt, history=reflect_history, call_site="reflect_plan"):
             yield chunk
             check_list_str += chunk
 
@@ -536,14 +617,18 @@ class MUSE(BaseAgent):
             create_message("assistant", f"* The check plan can be divided into the following steps:\n    {check_steps}")
         ])
 
-        for check_step, check_goal in check_list:
-            check_prompt = f"CheckStep:{check_step}\nCheckGoal:{check_goal}"
-            self.logger.log_task(check_prompt, subtitle="SUB-TASK REFLECT CHECKING···", title=f"Check: {check_step}")
-            async for chunk in self._reflect_react(check_prompt, reflect_history):
+        if self.reflect_workers > 1 and len(check_list) > 1:
+            async for chunk in self._parallel_reflect_checks(list(check_list), reflect_history):
                 yield chunk
+        else:
+            for check_step, check_goal in check_list:
+                check_prompt = f"CheckStep:{check_step}\nCheckGoal:{check_goal}"
+                self.logger.log_task(check_prompt, subtitle="SUB-TASK REFLECT CHECKING···", title=f"Check: {check_step}")
+                async for chunk in self._reflect_react(check_prompt, reflect_history):
+                    yield chunk
 
 
-        finish_str = await self.llm.async_generate(env_feedback + reflect_check_completion_prompt, history=reflect_history)
+        finish_str = await self.llm.async_generate(env_feedback + reflect_check_completion_prompt, history=reflect_history, call_site="reflect_verdict")
 
         finish = extract_json_codeblock(finish_str)[0]
         cur_subtask.finish = True if finish.get("finish", "no") == "yes" else False
@@ -553,7 +638,7 @@ class MUSE(BaseAgent):
         check_report = ""
         async for chunk in self.llm.async_stream_generate(
                 "Please compile your inspection results into a short report and submit it to the Task Agent. The report should at least include three parts: 'Title', 'Checklist Details', and 'Conclusion'." + self.language_prompt,
-                history=reflect_history
+                history=reflect_history, call_site="reflect_report"
         ):
             yield chunk
             check_report += chunk
@@ -566,7 +651,7 @@ class MUSE(BaseAgent):
         analysis = ""
         if not cur_subtask.finish:
             analysis__display_prompt = reflect_analyse_failure__display_prompt.format(check_report=check_report)
-            async for chunk in self.llm.async_stream_generate(analysis__display_prompt + reflect_analyse_failure__instruction_prompt + self.language_prompt, history=self.history):
+            async for chunk in self.llm.async_stream_generate(analysis__display_prompt + reflect_analyse_failure__instruction_prompt + self.language_prompt, history=self.history, call_site="reflect_analysis"):
                 yield chunk
                 analysis += chunk
             cur_subtask.trajectory.extend([
@@ -577,7 +662,7 @@ class MUSE(BaseAgent):
             if self.update_memory:
                 async for chunk in self.llm.async_stream_generate(
                         env_feedback + reflect_update_application_memory_prompt.format(guidance=self.memory_manager.application_enhance_dict) + self.language_prompt,
-                        history=reflect_history
+                        history=reflect_history, call_site="update_memory"
                     ):
                     yield chunk
                     analysis += chunk
@@ -602,12 +687,12 @@ class MUSE(BaseAgent):
     async def summarize_and_enhance(self):
         if self.update_memory:
             summarize_prompt = "Please summarize what you have done for this task." + self.language_prompt
-            async for chunk in self._in_context_step(summarize_prompt):
+            async for chunk in self._in_context_step(summarize_prompt, call_site="summarize"):
                 yield chunk
 
             env_feedback = self.get_env_feedback([])
 
-            async for chunk in self._in_context_step(summarize_success_and_failure_prompt.format(env_feedback=env_feedback) + self.language_prompt):
+            async for chunk in self._in_context_step(summarize_success_and_failure_prompt.format(env_feedback=env_feedback) + self.language_prompt, call_site="summarize"):
                 yield chunk
 
             # Gather full tool memory include tool_description and tool_instruction
@@ -619,7 +704,7 @@ class MUSE(BaseAgent):
                 }
             deep_update(tool_memory_dict, self.memory_manager.tool_enhance_dict)
 
-            inc_tasks = [self.llm.async_generate(prompt + self.language_prompt, history=self.history, max_tokens=None) for prompt in [
+            inc_tasks = [self.llm.async_generate(prompt + self.language_prompt, history=self.history, max_tokens=None, call_site="update_memory") for prompt in [
                 reflect_tool_enhance_prompt.format(tools=tool_memory_dict),
                 reflect_methodology_enhance_prompt
             ]]
@@ -632,7 +717,7 @@ class MUSE(BaseAgent):
             for tool_name in tool_enhance_dict:
                 self.monitor.inc_tool_modified(tool_name)
 
-            merge_tasks = [self.llm.async_generate(prompt + self.language_prompt, max_tokens=None) for prompt in [
+            merge_tasks = [self.llm.async_generate(prompt + self.language_prompt, max_tokens=None, call_site="merge_memory") for prompt in [
                 merge_application_prompt.format(guidance=self.memory_manager.application_enhance_dict),
                 merge_methodology_prompt.format(
                     old_methodology=str(self.memory_manager.methodology_enhance_dict),
@@ -666,11 +751,11 @@ class MUSE(BaseAgent):
         Multistep task planning, but the instructions during planning are not saved to working memory.
         Ultimately, only two messages are added to working memory: user_message->user_prompt, assistant_message->task_plan
         """
-        self.llm = LLM("gemini-2.5-flash-thinking")
+        self.llm = LLM.get("gemini-2.5-flash-thinking")
 
         cur_prompt = user_prompt + "\n\n" + MUSE_list_fact_prompt + self.language_prompt
         known_facts = ""
-        async for chunk in self.llm.async_stream_generate(cur_prompt, history=self.history):
+        async for chunk in self.llm.async_stream_generate(cur_prompt, history=self.history, call_site="plan"):
             yield chunk
             known_facts += chunk
         self.memory_manager.add_turn(create_message("user", user_prompt), create_message("assistant", known_facts))
@@ -689,7 +774,8 @@ class MUSE(BaseAgent):
             multi_steps_plan = ""
             async for chunk in self.llm.async_stream_generate(
                 cur_prompt,
-                history=self.history
+                history=self.history,
+                call_site="plan"
             ):
                 yield chunk
                 multi_steps_plan += chunk
@@ -711,10 +797,49 @@ class MUSE(BaseAgent):
         subtasks = "\n    ".join([f"{i + 1}. {subtask.name}: {subtask.goal}" for i, subtask in enumerate(self.to_do_subtasks)])
         self.history[-1] = create_message("assistant",f"{known_facts}\n\n* The task can be divided into the following subtasks:\n    {subtasks}")
 
-        self.llm = LLM("gemini-2.5-flash")
+        self.llm = LLM.get("gemini-2.5-flash")
 
-    async def _reflect_react(self, prompt: str, trajectory: List[dict], action_limit: int = 8):
+    async def _parallel_reflect_checks(self, check_list: List[Tuple[str, str]], reflect_history: List[Message]):
+        """
+        并行执行检查步骤: 每个步骤从共享的反思前缀 (系统提示词 + 检查计划) 分叉出独立轨迹, 至多 reflect_workers 个同时运行;
+        完成后按计划顺序输出各步骤的流式内容, 并将裁剪后的步骤轨迹 (保留最后一轮观察) 依次并入 reflect_history。
+        使用浏览器的步骤经 _BrowserGuard 在整个步骤内独占浏览器, 多步导航/点击不会与其他步骤交错。
+        启用常驻 Python 内核时各步骤共用同一命名空间 (执行串行, 但变量彼此可见), 检查代码不应依赖其他步骤未定义的变量。
+        """
+        semaphore = asyncio.Semaphore(self.reflect_workers)
+        browser_lock = asyncio.Lock()
+        prefix = list(reflect_history)
+
+        async def run_check(check_step: str, check_goal: str) -> Tuple[List[str], List[Message]]:
+            check_prompt = f"CheckStep:{check_step}\nCheckGoal:{check_goal}"
+            branch = list(prefix)
+            chunks = []
+            guard = _BrowserGuard(browser_lock)
+            async with semaphore:
+                self.logger.log_task(check_prompt, subtitle="SUB-TASK REFLECT CHECKING···", title=f"Check: {check_step}")
+                try:
+                    async for chunk in self._reflect_react(check_prompt, branch, browser_guard=guard):
+                        chunks.append(chunk)
+                finally:
+                    guard.release()
+            return chunks, branch[len(prefix):]
+
+        tasks = [asyncio.create_task(run_check(check_step, check_goal)) for check_step, check_goal in check_list]
+        try:
+            for task in tasks:
+                chunks, check_trajectory = await task
+                for chunk in chunks:
+                    yield chunk
+                self.memory_manager.trim_traj(check_trajectory, preserve_last=1)
+                reflect_history.extend(check_trajectory)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _reflect_react(self, prompt: str, trajectory: List[Message], action_limit: int = 8, browser_guard: _BrowserGuard = None):
         start_index = len(trajectory)
+        # 反思轨迹中没有执行阶段的可访问性树, 同样从完整树开始观测
+        await self.tool_registrar.reset_observations(current_agent_key.get())
         cur_prompt = reflect_execute_check__instruction_prompt.format(check_step=prompt, step_limit=action_limit) + self.language_prompt
         exist_tool_call = True
         actions = 0
@@ -722,7 +847,7 @@ class MUSE(BaseAgent):
             ai_response = ""
             async for chunk in self.llm.async_stream_generate(
                     cur_prompt if actions == 0 else reflect_action_with_observation_prompt.format(observation=cur_prompt) + self.language_prompt,
-                    history=trajectory
+                    history=trajectory, call_site="reflect_check"
             ):
                 yield chunk
                 ai_response += chunk
@@ -740,6 +865,11 @@ class MUSE(BaseAgent):
             if parse_result.tool_json:
                 self.logger.log_task(str(parse_result.tool_json), subtitle="SUB-TASK REFLECT REACTING······", title=f"ReAct Check: Action {actions + 1}, Max {action_limit}")
 
+                if browser_guard is not None and str(parse_result.tool_json.get("tool_name", "")).startswith("browser_"):
+                    if await browser_guard.claim():
+                        # 其他检查步骤可能刚用过浏览器, 本步骤的第一次观测返回完整树
+                        await self.tool_registrar.reset_observations(current_agent_key.get())
+
                 tool_call_result = None
                 async for status, chunk in self.call_tool(**parse_result.tool_json):
                     if status == "[DONE]":
@@ -794,18 +924,24 @@ class MUSE(BaseAgent):
             "instruction": ""
         }
         if tool_name == "python":
-            result = self.python_interpreter(arguments["code"])
-            yield "[STREAMING]", result
-            tool_result["data"] = result
+            async for tool_chunk in self.run_python(arguments["code"]):
+                yield "[STREAMING]", tool_chunk["data"]
+                if not tool_chunk.get("progress", False):
+                    tool_result["data"] += tool_chunk["data"]
         else:
             tool_function = self.tool_registrar.get_tool(tool_name)
             if tool_function:
                 try:
                     async for tool_chunk in tool_function(**arguments):
                         ToolResultFormatValidator.model_validate(tool_chunk)
+                        if tool_chunk.get("metrics"):
+                            self.monitor.add_tool_metrics(tool_name, tool_chunk["metrics"])
 
                         chunk = tool_chunk["data"]
                         yield "[STREAMING]", chunk
+                        # progress 分片只实时展示给操作者, 不计入工具结果
+                        if tool_chunk.get("progress", False):
+                            continue
 
                         tool_result["data"] += chunk
                         tool_result["instruction"] = tool_chunk.get("instruction", "")
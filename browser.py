@@ -2,7 +2,15 @@
 import os
 import re
 import json
+import time
+import base64
+import shutil
+import asyncio
+import difflib
+import tempfile
 from pathlib import Path
+from dataclasses import dataclass
+from collections import OrderedDict
 
 from browser_use.llm.openai.chat import ChatOpenAI
 from browser_use.controller.service import Controller
@@ -12,11 +20,99 @@ from browser_use.controller.registry.views import ActionModel
 from browser_use.browser import BrowserProfile, BrowserSession
 from browser_use.config import get_default_profile, load_browser_use_config, get_default_llm, FlatEnvConfig
 
+from utils import estimate_tokens, downscale_image
+
+
+# 在页面中安装 MutationObserver (每个文档只装一次): 记录最近一次 DOM 变化的时间, 并累计除 browser-use 高亮层以外的
+# DOM 变化次数 (高亮框在每次读取页面状态时重绘, 不代表页面内容改变)。
+_DOM_OBSERVER_JS = """
+    if (window.__museLastMutation === undefined) {
+        const highlightId = "playwright-highlight-container";
+        const inHighlight = (node) => {
+            const element = node.nodeType === 1 ? node : node.parentElement;
+            return !!(element && element.closest && element.closest("#" + highlightId));
+        };
+        const relevant = (record) => {
+            if (inHighlight(record.target)) return false;
+            if (record.type !== "childList") return true;
+            return [...record.addedNodes, ...record.removedNodes].some((node) => node.id !== highlightId);
+        };
+        window.__museLastMutation = performance.now();
+        window.__museMutations = 0;
+        new MutationObserver((records) => {
+            window.__museLastMutation = performance.now();
+            window.__museMutations += records.filter(relevant).length;
+        }).observe(document, {subtree: true, childList: true, attributes: true, characterData: true});
+    }
+"""
+# 返回距最近一次 DOM 变化的毫秒数与 readyState, 供页面稳定检测使用。
+_DOM_QUIET_JS = "() => {" + _DOM_OBSERVER_JS + """
+    return [performance.now() - window.__museLastMutation, document.readyState];
+}"""
+# 返回文档标识 (timeOrigin, 每次导航/刷新都不同)、DOM 变化计数、滚动位置与视口尺寸, 作为视觉缓存的廉价页面状态键。
+_PAGE_STATE_JS = "() => {" + _DOM_OBSERVER_JS + """
+    return [performance.timeOrigin, window.__museMutations, window.scrollX, window.scrollY, window.innerWidth, window.innerHeight];
+}"""
+
+
+class _NetworkActivity:
+    """记录单个页面的在途请求数与最近一次网络事件时间, 供页面稳定检测判断网络是否空闲。"""
+
+    def __init__(self, page):
+        self.inflight = set()
+        self.last_event = time.monotonic()
+        page.on("request", self._on_start)
+        page.on("requestfinished", self._on_end)
+        page.on("requestfailed", self._on_end)
+
+    def _on_start(self, request):
+        self.inflight.add(request)
+        self.last_event = time.monotonic()
+
+    def _on_end(self, request):
+        self.inflight.discard(request)
+        self.last_event = time.monotonic()
+
+
+# execute_batch 支持的动作: 名称 -> (browser-use 动作名, 允许的参数, 默认参数)。参数与 BrowserUse 同名方法一致。
+BATCH_ACTIONS = {
+    "go_to_url": ("go_to_url", ("url", "new_tab"), {"new_tab": False}),
+    "click_element_by_index": ("click_element_by_index", ("index",), {}),
+    "input_text": ("input_text", ("index", "text"), {}),
+    "send_keys": ("send_keys", ("keys",), {}),
+    "select_dropdown_option": ("select_dropdown_option", ("index", "text"), {}),
+    "scroll": ("scroll", ("down", "num_pages", "index"), {"down": True, "num_pages": 0.5, "index": None}),
+    "go_back": ("go_back", (), {}),
+    "wait": ("wait", ("seconds",), {"seconds": 1}),
+    "switch_tab": ("switch_tab", ("tab_index",), {}),
+}
+
+
+@dataclass
+class AxTreeBaseline:
+    """某个标签页最近一次完整输出给模型的可访问性树, 作为后续增量 diff 的基准。"""
+    url: str
+    text: str
+    seq: int
+
 
 class BrowserUse:
     """封装 BrowserUse 交互流程的高层接口, 负责浏览器会话与工具调用的初始化。"""
 
-    def __init__(self):
+    def __init__(
+            self,
+            observation_mode: str = "full",
+            diff_max_ratio: float = 0.3,
+            diff_max_chain: int = 2,
+            observation_token_budget: int | None = None,
+            settle_timeout: float = 5.0,
+            settle_quiet_ms: int = 500,
+            settle_max_inflight: int = 2,
+            user_data_dir: str = '~/.config/browseruse/profiles/default',
+            screenshot_max_edge: int | None = 1568,
+            screenshot_quality: int = 80,
+            vision_cache_size: int = 16
+    ):
         # 读取 browser-use 的配置, 控制浏览器默认行为与 LLM 模型参数。
         self.config = load_browser_use_config()
         # 浏览器状态由 BrowserSession 管理, 用于控制页面、标签、截图等信息。
@@ -27,6 +123,40 @@ class BrowserUse:
         # self.file_system: FileSystem | None = None
         # LLM 对象负责在需要视觉理解时调用多模态模型。
         self.llm: ChatOpenAI | None = None
+        # 缓存的动作模型类, 由 _get_action_model 在第一次动作时构建。
+        self._action_model: type[ActionModel] | None = None
+        # 浏览器 profile 目录; 由 BrowserPool 创建时为每个实例分配独立的临时目录, 避免多个浏览器争用同一 profile。
+        self.user_data_dir = user_data_dir
+
+        # 观测模式: "full" 每次返回完整可访问性树; "diff" 在页面变化较小时只返回相对基准树的增量。
+        # diff_max_chain 限制基准树之后最多连续输出几次 diff, 需小于 trim_traj 的 preserve_last,
+        # 保证模型上下文中始终能看到 diff 所依赖的那棵完整树。
+        if observation_mode not in ("full", "diff"):
+            raise ValueError(f"observation_mode must be 'full' or 'diff', but received '{observation_mode}'")
+        self.observation_mode = observation_mode
+        self.diff_max_ratio = diff_max_ratio
+        self.diff_max_chain = diff_max_chain
+        self._axtree_baselines: dict[int, AxTreeBaseline] = {}
+        self._observation_seq = 0
+        # 每个页面复用一个已启用 Accessibility/DOM 域的 CDP 会话, 页面关闭时自动失效。
+        self._cdp_sessions: dict[int, object] = {}
+        # 可访问性树观测的 token 预算 (None 表示不限制), 超出时由 prune_axtree_str 裁剪并标注被省略的内容。
+        self.observation_token_budget = observation_token_budget
+        # 页面稳定检测: 动作后等待导航完成、网络空闲 (在途请求不超过 settle_max_inflight, 容忍长连接/轮询)
+        # 且 DOM 连续 settle_quiet_ms 毫秒无变化, 最多等待 settle_timeout 秒, 取代固定的 sleep。
+        self.settle_timeout = settle_timeout
+        self.settle_quiet_ms = settle_quiet_ms
+        self.settle_max_inflight = settle_max_inflight
+        self._network_activity: dict[int, _NetworkActivity] = {}
+        # 视觉问答的截图: 统一经 capture_screenshot 截取一次, 可裁剪到元素/区域, 按最长边与 JPEG 质量压缩;
+        # 截图与问答结果按页面状态 (URL、文档标识、DOM 变化计数、滚动位置与视口) 做 LRU 缓存, 页面未变化时不重复截图或上传。
+        self.screenshot_max_edge = screenshot_max_edge
+        self.screenshot_quality = screenshot_quality
+        self.vision_cache_size = vision_cache_size
+        self._screenshot_cache: OrderedDict[tuple, str] = OrderedDict()
+        self._vision_cache: OrderedDict[tuple, str] = OrderedDict()
+        # 同一浏览器上的 "动作 + 观测" 需要原子执行; 并行反思时多个检查步骤共享该浏览器, 由工具层持有此锁串行化。
+        self.lock = asyncio.Lock()
 
     # TODO: Need to expose more path parameters to initialization
     async def _init_browser_session(self, **kwargs):
@@ -42,7 +172,7 @@ class BrowserUse:
             'downloads_path': '/workspace/downloads',
             'wait_between_actions': 0.5,
             'keep_alive': True,
-            'user_data_dir': '~/.config/browseruse/profiles/default',
+            'user_data_dir': self.user_data_dir,
             'is_mobile': False,
             'device_scale_factor': 1.0,
             'disable_security': False,
@@ -62,9 +192,16 @@ class BrowserUse:
         # Create browser session
         self.browser_session = BrowserSession(browser_profile=profile)
         await self.browser_session.start()
+        # 页面创建时即挂载网络请求监听, 动作触发的请求 (包括新标签页中的) 从一开始就被计入, 页面稳定检测不会过早判定网络空闲
+        browser_context = getattr(self.browser_session, "browser_context", None)
+        if browser_context is not None:
+            for page in browser_context.pages:
+                self._track_network(page)
+            browser_context.on("page", self._track_network)
 
         # Create controller for direct actions
         self.controller = Controller()
+        self._action_model = None
 
         self.llm = ChatOpenAI(
             model='gemini-2.5-pro',
@@ -78,16 +215,141 @@ class BrowserUse:
         file_system_path = profile_data.get('file_system_path', '/workspace/browser-use')
         self.file_system = FileSystem(base_dir=Path(file_system_path).expanduser())
 
-    async def get_axtree(self):
+    async def start(self):
+        """提前启动浏览器会话 (已启动时不做任何事), 供 BrowserPool 预热使用。"""
+        await self._init_browser_session()
+
+    async def _get_cdp_session(self, page):
+        """返回该页面缓存的 CDP 会话, 不存在时创建并启用所需的域; 页面关闭时从缓存中移除。"""
+        key = id(page)
+        cdp_session = self._cdp_sessions.get(key)
+        if cdp_session is None:
+            cdp_session = await page.context.new_cdp_session(page)
+            await cdp_session.send('Accessibility.enable')
+            await cdp_session.send('DOM.enable')
+            self._cdp_sessions[key] = cdp_session
+            page.once("close", lambda _: self._cdp_sessions.pop(key, None))
+        return cdp_session
+
+    async def _drop_cdp_session(self, page):
+        """丢弃并尽量 detach 页面对应的 CDP 会话, 用于会话失效 (如跨进程导航换了 target) 的情况。"""
+        cdp_session = self._cdp_sessions.pop(id(page), None)
+        if cdp_session is not None:
+            try:
+                await cdp_session.detach()
+            except Exception:
+                pass
+
+    async def get_axtree(self, page=None):
         """抓取当前页面的可访问性树, 为可视化分析或调试提供结构化描述。"""
-        page = await self.browser_session.get_current_page()
-        cdp_session = await page.context.new_cdp_session(page)
+        if page is None:
+            page = await self.browser_session.get_current_page()
+        try:
+            cdp_session = await self._get_cdp_session(page)
+            ax_tree = await cdp_session.send('Accessibility.getFullAXTree')
+        except Exception:
+            # 缓存的会话可能已随 target 切换而失效, 重建一次后重试
+            await self._drop_cdp_session(page)
+            cdp_session = await self._get_cdp_session(page)
+            ax_tree = await cdp_session.send('Accessibility.getFullAXTree')
+        return flatten_axtree_to_str(ax_tree)
 
-        await cdp_session.send('Accessibility.enable')
-        await cdp_session.send('DOM.enable')
+    async def close(self):
+        """detach 所有缓存的 CDP 会话并关闭浏览器会话。"""
+        for cdp_session in list(self._cdp_sessions.values()):
+            try:
+                await cdp_session.detach()
+            except Exception:
+                pass
+        self._cdp_sessions.clear()
+        self._axtree_baselines.clear()
+        self._network_activity.clear()
+        self._screenshot_cache.clear()
+        self._vision_cache.clear()
+        if self.browser_session is not None:
+            try:
+                await self.browser_session.kill()
+            except Exception as e:
+                print(f"[SYSTEM WARNING][BROWSER] ⚠️ Failed to close browser session: {e}")
+            self.browser_session = None
+
+    def _track_network(self, page) -> _NetworkActivity:
+        """为页面挂载请求事件监听 (每个页面一次, 在页面创建时或动作开始前调用), 页面关闭时移除记录。"""
+        key = id(page)
+        activity = self._network_activity.get(key)
+        if activity is None:
+            activity = self._network_activity[key] = _NetworkActivity(page)
+            page.once("close", lambda _: self._network_activity.pop(key, None))
+        return activity
+
+    async def wait_for_settle(self, timeout: float | None = None) -> float:
+        """
+        等待当前页面稳定: 没有进行中的导航、网络空闲且 DOM 在静默窗口内无变化, 最多等待 timeout 秒
+        (默认 settle_timeout)。页面稳定后立即返回, 返回值为实际等待的秒数。
+        """
+        start = time.monotonic()
+        if not self.browser_session:
+            return 0.0
+        timeout = self.settle_timeout if timeout is None else timeout
+        deadline = start + timeout
+        quiet = self.settle_quiet_ms / 1000
 
-        ax_tree = await cdp_session.send('Accessibility.getFullAXTree')
-        return flatten_axtree_to_str(ax_tree)
+        page = await self.browser_session.get_current_page()
+        activity = self._track_network(page)
+        while time.monotonic() < deadline:
+            try:
+                # 导航进行中时等待新文档可用, 之后在新文档中重新安装 MutationObserver
+                await page.wait_for_load_state("domcontentloaded", timeout=max(deadline - time.monotonic(), 0.001) * 1000)
+                dom_quiet_ms, ready_state = await page.evaluate(_DOM_QUIET_JS)
+            except Exception:
+                # 执行上下文随导航被销毁, 或等待超时; 稍后重试直至截止时间
+                await asyncio.sleep(0.1)
+                continue
+            now = time.monotonic()
+            network_idle = len(activity.inflight) <= self.settle_max_inflight and now - activity.last_event >= quiet
+            if ready_state != "loading" and network_idle and dom_quiet_ms >= self.settle_quiet_ms:
+                break
+            await asyncio.sleep(0.1)
+        return round(time.monotonic() - start, 3)
+
+    async def observe_axtree(self, force_full: bool = False, token_budget: int | None = None) -> str:
+        """
+        返回供模型阅读的可访问性树观测。先按 token 预算裁剪 (token_budget 优先于实例级 observation_token_budget);
+        diff 模式下, 同一标签页、URL 未变且变化较小时只返回相对基准树的增量,
+        发生导航、变化过大、距基准太久或 force_full=True 时回退为完整树并刷新基准。
+        """
+        if not self.browser_session:
+            return 'Error: No browser session active, please use go to a url'
+        page = await self.browser_session.get_current_page()
+        axtree = await self.get_axtree(page)
+        budget = token_budget if token_budget is not None else self.observation_token_budget
+        if budget:
+            axtree = prune_axtree_str(axtree, budget)
+        self._observation_seq += 1
+        if self.observation_mode != "diff":
+            return axtree
+
+        key = id(page)
+        baseline = self._axtree_baselines.get(key)
+        if (
+            not force_full
+            and baseline is not None
+            and baseline.url == page.url
+            and self._observation_seq - baseline.seq <= self.diff_max_chain
+        ):
+            diff = diff_axtree_str(baseline.text, axtree, self.diff_max_ratio)
+            if diff is not None:
+                return diff
+
+        self._axtree_baselines[key] = AxTreeBaseline(url=page.url, text=axtree, seq=self._observation_seq)
+        return axtree
+
+    def reset_observation_baseline(self):
+        """
+        丢弃所有标签页的 diff 基准, 下一次观测返回完整树。智能体在每个 ReAct 循环开始时调用:
+        此时模型上下文 (新的子任务轨迹被裁剪后的历史、反思轨迹) 中已没有之前的完整树, diff 无从参照。
+        """
+        self._axtree_baselines.clear()
 
     async def get_browser_state(self) -> str:
         """提取当前页面的摘要信息, 包括 URL、标题与可交互元素。"""
@@ -125,9 +387,60 @@ class BrowserUse:
             result['interactive_elements'].append(elem_info)
         return json.dumps(result["interactive_elements"])
 
-    async def extract_content_by_vision(self, query: str) -> str:
-        """利用多模态 LLM 对当前页面截图进行问答, 实现视觉信息提取。"""
-        state = await self.browser_session.get_state_summary(cache_clickable_elements_hashes=False)
+    async def _page_state_key(self, page) -> tuple:
+        """
+        页面状态键: URL、文档标识、DOM 变化计数 (不含高亮层)、滚动位置与视口尺寸, 任一变化都视为页面已改变。
+        只需一次 page.evaluate, 不抓取可访问性树, 大页面上也远比视觉调用本身便宜。
+        """
+        state = await page.evaluate(_PAGE_STATE_JS)
+        return id(page), page.url, *state
+
+    @staticmethod
+    def _lru_put(cache: OrderedDict, key: tuple, value: str, max_size: int):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > max_size:
+            cache.popitem(last=False)
+
+    async def capture_screenshot(self, index: int | None = None, region: list[int] | None = None, state_key: tuple | None = None) -> str:
+        """
+        截取当前页面视口 (index 指定时裁剪到该交互元素, region=[x, y, width, height] 时裁剪到视口区域),
+        按 screenshot_max_edge/screenshot_quality 压缩后返回 base64 JPEG。同一页面状态下的相同截图请求直接复用缓存。
+        """
+        page = await self.browser_session.get_current_page()
+        state_key = state_key or await self._page_state_key(page)
+        cache_key = (state_key, index, tuple(region) if region else None)
+        if cache_key in self._screenshot_cache:
+            self._screenshot_cache.move_to_end(cache_key)
+            return self._screenshot_cache[cache_key]
+
+        if index is not None:
+            element = await self.browser_session.get_dom_element_by_index(index)
+            handle = await self.browser_session.get_locate_element(element) if element is not None else None
+            if handle is None:
+                raise ValueError(f"Element with index {index} was not found on the current page")
+            data = await handle.screenshot(type="jpeg", quality=self.screenshot_quality)
+        elif region:
+            x, y, width, height = region
+            data = await page.screenshot(type="jpeg", quality=self.screenshot_quality, clip={"x": x, "y": y, "width": width, "height": height})
+        else:
+            data = await page.screenshot(type="jpeg", quality=self.screenshot_quality)
+
+        data, _ = downscale_image(data, "jpeg", self.screenshot_max_edge, self.screenshot_quality)
+        screenshot = base64.b64encode(data).decode("utf-8")
+        self._lru_put(self._screenshot_cache, cache_key, screenshot, self.vision_cache_size)
+        return screenshot
+
+    async def extract_content_by_vision(self, query: str, index: int | None = None, region: list[int] | None = None) -> str:
+        """利用多模态 LLM 对当前页面截图 (可裁剪到元素或区域) 进行问答; 页面未变化时相同问题直接返回缓存结果。"""
+        page = await self.browser_session.get_current_page()
+        state_key = await self._page_state_key(page)
+        cache_key = (state_key, index, tuple(region) if region else None, query)
+        if cache_key in self._vision_cache:
+            self._vision_cache.move_to_end(cache_key)
+            return self._vision_cache[cache_key]
+
+        screenshot = await self.capture_screenshot(index, region, state_key=state_key)
         response = await self.llm.get_client().chat.completions.create(
             model=self.llm.model,
             messages=[
@@ -135,157 +448,130 @@ class BrowserUse:
                     {"type": "text", "text": query},
                     {
                         "type": "image_url",
-                        "image_url": {"url": f"data:image/jpeg;base64,{state.screenshot}"}
+                        "image_url": {"url": f"data:image/jpeg;base64,{screenshot}"}
                     }
                 ]}
             ]
         )
-        await self.browser_session.remove_highlights()
-        return response.choices[0].message.content
-
-    async def go_to_url(self, url: str, new_tab: bool):
-        """导航至指定网址, new_tab=True 时在新标签页打开。"""
-        if not self.browser_session:
-            await self._init_browser_session()
-
-        action = self.controller.registry.create_action_model()(go_to_url={"url": url, "new_tab": new_tab})
+        answer = response.choices[0].message.content
+        self._lru_put(self._vision_cache, cache_key, answer, self.vision_cache_size)
+        return answer
+
+    def _get_action_model(self) -> type[ActionModel]:
+        """返回缓存的动作模型类; 注册表在会话期间不变, 无需每次动作都重新构建。"""
+        if self._action_model is None:
+            self._action_model = self.controller.registry.create_action_model()
+        return self._action_model
+
+    async def _act(self, name: str, params: dict, remove_highlights: bool = True) -> str:
+        """通用动作分发: 构建并执行 browser-use 动作, 返回提取的内容或以 "ERROR: " 开头的错误信息。"""
+        action = self._get_action_model()(**{name: params})
+        # 在动作开始前挂载网络监听 (已挂载时无操作), 保证动作发出的请求都被 wait_for_settle 看到
+        self._track_network(await self.browser_session.get_current_page())
         action_result = await self.controller.act(
             action=action,
             browser_session=self.browser_session,
             file_system=self.file_system,
         )
 
-        await self.browser_session.remove_highlights()
+        if remove_highlights:
+            await self.browser_session.remove_highlights()
         if action_result.error is None:
             return action_result.extracted_content
         else:
             return "ERROR: " + action_result.error
 
+    async def execute_batch(self, actions: list[dict]) -> list[str]:
+        """
+        依次执行一组动作, 每个动作形如 {"action": "input_text", "index": 3, "text": "..."}, 参数与同名方法一致。
+        遇到错误即停止 (后续动作通常依赖前面的结果), 全部执行后只清理一次高亮。返回每个已执行动作的结果。
+        """
+        if not self.browser_session:
+            await self._init_browser_session()
+
+        results = []
+        try:
+            for i, step in enumerate(actions):
+                if not isinstance(step, dict):
+                    results.append(f"ERROR: Step {i + 1} must be an object with an \"action\" name, got {step!r}")
+                    break
+                step = dict(step)
+                name = step.pop("action", None)
+                if name not in BATCH_ACTIONS:
+                    results.append(f"ERROR: Unsupported action {name!r} at step {i + 1}, supported actions: {', '.join(BATCH_ACTIONS)}")
+                    break
+                browser_use_name, param_names, defaults = BATCH_ACTIONS[name]
+                unknown = set(step) - set(param_names)
+                if unknown:
+                    results.append(f"ERROR: Unknown parameters {sorted(unknown)} for action {name!r} at step {i + 1}")
+                    break
+                missing = [p for p in param_names if p not in step and p not in defaults]
+                if missing:
+                    results.append(f"ERROR: Missing required parameters {missing} for action {name!r} at step {i + 1}")
+                    break
+                params = {**defaults, **step}
+                # 标签页动作在 browser-use 中以 page_id 标识
+                if "tab_index" in params:
+                    params["page_id"] = params.pop("tab_index")
+                try:
+                    result = await self._act(browser_use_name, params, remove_highlights=False)
+                except Exception as e:
+                    # 参数类型不合法等在构建/执行动作时抛出的异常同样作为该步骤的错误结果, 而不是让整个工具调用失败
+                    result = f"ERROR: Action {name!r} at step {i + 1} failed: {e}"
+                results.append(result)
+                if isinstance(result, str) and result.startswith("ERROR: "):
+                    break
+        finally:
+            await self.browser_session.remove_highlights()
+        return results
+
+    async def go_to_url(self, url: str, new_tab: bool):
+        """导航至指定网址, new_tab=True 时在新标签页打开。"""
+        if not self.browser_session:
+            await self._init_browser_session()
+        return await self._act("go_to_url", {"url": url, "new_tab": new_tab})
+
     async def wait(self, seconds: int):
         """调用内置 wait 动作, 让浏览器在当前页面停留指定秒数。"""
         if not self.browser_session:
             return 'Error: No browser session active, please use go to a url'
-
-        action = self.controller.registry.create_action_model()(wait={"seconds": seconds})
-        action_result = await self.controller.act(
-            action=action,
-            browser_session=self.browser_session,
-            file_system=self.file_system,
-        )
-
-        await self.browser_session.remove_highlights()
-        if action_result.error is None:
-            return action_result.extracted_content
-        else:
-            return "ERROR: " + action_result.error
+        return await self._act("wait", {"seconds": seconds})
 
     async def click_element_by_index(self, index: int):
         """通过索引点击先前 `get_browser_state` 返回的交互元素。"""
         if not self.browser_session:
             return 'Error: No browser session active, please use go to a url'
-
-        action = self.controller.registry.create_action_model()(click_element_by_index={"index": index})
-        action_result = await self.controller.act(
-            action=action,
-            browser_session=self.browser_session,
-            file_system=self.file_system,
-        )
-
-        await self.browser_session.remove_highlights()
-        if action_result.error is None:
-            return action_result.extracted_content
-        else:
-            return "ERROR: " + action_result.error
+        return await self._act("click_element_by_index", {"index": index})
 
     async def input_text(self, index: int, text: str):
         """向指定输入框填写文本, 索引对应交互元素列表中的位置。"""
         if not self.browser_session:
             return 'Error: No browser session active, please use go to a url'
-
-        action = self.controller.registry.create_action_model()(input_text={"index": index, "text": text})
-        action_result = await self.controller.act(
-            action=action,
-            browser_session=self.browser_session,
-            file_system=self.file_system,
-        )
-
-        await self.browser_session.remove_highlights()
-        if action_result.error is None:
-            return action_result.extracted_content
-        else:
-            return "ERROR: " + action_result.error
+        return await self._act("input_text", {"index": index, "text": text})
 
     async def send_keys(self, keys: str):
         """模拟键盘输入, 常用于快捷键交互。"""
         if not self.browser_session:
             return 'Error: No browser session active, please use go to a url'
-
-        action = self.controller.registry.create_action_model()(send_keys={"keys": keys})
-        action_result = await self.controller.act(
-            action=action,
-            browser_session=self.browser_session,
-            file_system=self.file_system,
-        )
-
-        await self.browser_session.remove_highlights()
-        if action_result.error is None:
-            return action_result.extracted_content
-        else:
-            return "ERROR: " + action_result.error
+        return await self._act("send_keys", {"keys": keys})
 
     async def upload_file(self, index: int, path: str):
         """触发文件上传控件, path 为容器内文件路径。"""
         if not self.browser_session:
             return 'Error: No browser session active, please use go to a url'
-
-        action = self.controller.registry.create_action_model()(upload_file={"index": index, "path": path})
-        action_result = await self.controller.act(
-            action=action,
-            browser_session=self.browser_session,
-            file_system=self.file_system,
-        )
-
-        await self.browser_session.remove_highlights()
-        if action_result.error is None:
-            return action_result.extracted_content
-        else:
-            return "ERROR: " + action_result.error
+        return await self._act("upload_file", {"index": index, "path": path})
 
     async def go_back(self):
         """在浏览器历史记录中后退一步。"""
         if not self.browser_session:
             return 'Error: No browser session active, please use go to a url'
-
-        action = self.controller.registry.create_action_model()(go_back={})
-        action_result = await self.controller.act(
-            action=action,
-            browser_session=self.browser_session,
-            file_system=self.file_system,
-        )
-
-        await self.browser_session.remove_highlights()
-        if action_result.error is None:
-            return action_result.extracted_content
-        else:
-            return "ERROR: " + action_result.error
+        return await self._act("go_back", {})
 
     async def scroll(self, down: bool, num_pages: float, index: int):
         """控制页面滚动, down 表示方向, num_pages 控制滚动距离。"""
         if not self.browser_session:
             return 'Error: No browser session active, please use go to a url'
-
-        action = self.controller.registry.create_action_model()(scroll={"down": down, "num_pages": num_pages, "index": index})
-        action_result = await self.controller.act(
-            action=action,
-            browser_session=self.browser_session,
-            file_system=self.file_system,
-        )
-
-        await self.browser_session.remove_highlights()
-        if action_result.error is None:
-            return action_result.extracted_content
-        else:
-            return "ERROR: " + action_result.error
+        return await self._act("scroll", {"down": down, "num_pages": num_pages, "index": index})
 
     async def list_tabs(self):
         """列出当前所有标签页, 返回每个标签的 page_id 与标题。"""
@@ -294,7 +580,6 @@ class BrowserUse:
 
         state = await self.browser_session.get_state_summary(cache_clickable_elements_hashes=False)
         tabs = [{'index': tab.page_id, 'url': tab.url, 'title': tab.title} for tab in state.tabs]
-
         await self.browser_session.remove_highlights()
         return tabs
 
@@ -302,116 +587,482 @@ class BrowserUse:
         """根据 page_id 切换激活的标签页。"""
         if not self.browser_session:
             return 'Error: No browser session active, please use go to a url'
-
-        action = self.controller.registry.create_action_model()(switch_tab={"page_id": tab_index})
-        action_result = await self.controller.act(
-            action=action,
-            browser_session=self.browser_session,
-            file_system=self.file_system,
-        )
-
-        await self.browser_session.remove_highlights()
-        if action_result.error is None:
-            return action_result.extracted_content
-        else:
-            return "ERROR: " + action_result.error
+        return await self._act("switch_tab", {"page_id": tab_index})
 
     async def close_tab(self, tab_index: int):
-        """关闭指定 page_id 的标签页。"""
+        """关闭指定 page_id 的标签页, 该页面缓存的 CDP 会话会在 close 事件中失效。"""
         if not self.browser_session:
             return 'Error: No browser session active, please use go to a url'
-
-        action = self.controller.registry.create_action_model()(close_tab={"page_id": tab_index})
-        action_result = await self.controller.act(
-            action=action,
-            browser_session=self.browser_session,
-            file_system=self.file_system,
-        )
-
-        await self.browser_session.remove_highlights()
-        if action_result.error is None:
-            return action_result.extracted_content
-        else:
-            return "ERROR: " + action_result.error
+        return await self._act("close_tab", {"page_id": tab_index})
 
     async def get_dropdown_options(self, index: int):
         """读取下拉框可选项, 供后续选择动作参考。"""
         if not self.browser_session:
             return 'Error: No browser session active, please use go to a url'
-
-        action = self.controller.registry.create_action_model()(get_dropdown_options={"index": index})
-        action_result = await self.controller.act(
-            action=action,
-            browser_session=self.browser_session,
-            file_system=self.file_system,
-        )
-
-        await self.browser_session.remove_highlights()
-        if action_result.error is None:
-            return action_result.extracted_content
-        else:
-            return "ERROR: " + action_result.error
+        return await self._act("get_dropdown_options", {"index": index})
 
     async def select_dropdown_option(self, index: int, text: str):
         """从下拉框中选择指定文本的选项。"""
         if not self.browser_session:
             return 'Error: No browser session active, please use go to a url'
-
-        action = self.controller.registry.create_action_model()(select_dropdown_option={"index": index, "text": text})
-        action_result = await self.controller.act(
-            action=action,
-            browser_session=self.browser_session,
-            file_system=self.file_system,
-        )
-
-        await self.browser_session.remove_highlights()
-        if action_result.error is None:
-            return action_result.extracted_content
-        else:
-            return "ERROR: " + action_result.error
+        return await self._act("select_dropdown_option", {"index": index, "text": text})
+
+@dataclass
+class _BrowserLease:
+    """BrowserPool 中分配给某个 key 的浏览器及其最近使用时间。"""
+    browser: BrowserUse
+    last_used: float
+
+
+class BrowserPool:
+    """
+    按智能体/任务 key 分配 BrowserUse 实例的浏览器池, 用于在同一进程内并行运行多个任务:
+    每个浏览器使用独立的临时 profile; 运行中的浏览器总数 (已分配 + 预热) 不超过 max_browsers,
+    超出时 acquire 等待其他 key 释放; 超过 idle_timeout 秒未使用的浏览器会被回收;
+    warm_browsers > 0 时在后台预先启动相应数量的浏览器, 新任务无需冷启动 Chromium。
+    """
+
+    def __init__(
+            self,
+            max_browsers: int = 4,
+            warm_browsers: int = 0,
+            idle_timeout: float | None = 1800,
+            browser_kwargs: dict | None = None
+    ):
+        if max_browsers < 1:
+            raise ValueError(f"max_browsers must be at least 1, but received {max_browsers}")
+        self.max_browsers = max_browsers
+        self.warm_browsers = min(warm_browsers, max_browsers)
+        self.idle_timeout = idle_timeout
+        self.browser_kwargs = browser_kwargs or {}
+
+        self._leases: dict[str, _BrowserLease] = {}
+        self._warm: list[BrowserUse] = []
+        self._key_locks: dict[str, asyncio.Lock] = {}
+        self._cond = asyncio.Condition()
+        # 已占用的名额: 已分配 + 预热完成 + 正在预热的浏览器
+        self._num_browsers = 0
+        self._warming: set[asyncio.Task] = set()
+        self._reaper: asyncio.Task | None = None
+
+    def _new_browser(self) -> BrowserUse:
+        return BrowserUse(**self.browser_kwargs, user_data_dir=tempfile.mkdtemp(prefix="muse-browser-profile-"))
+
+    @staticmethod
+    async def _dispose(browser: BrowserUse):
+        await browser.close()
+        shutil.rmtree(browser.user_data_dir, ignore_errors=True)
+
+    async def acquire(self, key: str) -> BrowserUse:
+        """返回分配给 key 的浏览器; 首次调用时优先取用预热的浏览器, 达到并发上限时等待。"""
+        self._ensure_background_tasks()
+        async with self._key_locks.setdefault(key, asyncio.Lock()):
+            lease = self._leases.get(key)
+            if lease is None:
+                async with self._cond:
+                    await self._cond.wait_for(lambda: self._warm or self._num_browsers < self.max_browsers)
+                    if self._warm:
+                        browser = self._warm.pop()
+                    else:
+                        # 未预热的浏览器保持惰性启动, 在第一次 go_to_url 时才真正拉起 Chromium
+                        self._num_browsers += 1
+                        browser = self._new_browser()
+                lease = self._leases[key] = _BrowserLease(browser, time.monotonic())
+                self._schedule_warm()
+            lease.last_used = time.monotonic()
+            return lease.browser
+
+    def peek(self, key: str) -> BrowserUse | None:
+        """返回已分配给 key 的浏览器, 不分配新浏览器。"""
+        lease = self._leases.get(key)
+        return lease.browser if lease is not None else None
+
+    def touch(self, key: str):
+        """记录 key 的浏览器刚被使用过, 推迟其空闲回收。"""
+        lease = self._leases.get(key)
+        if lease is not None:
+            lease.last_used = time.monotonic()
+
+    async def release(self, key: str):
+        """关闭 key 对应的浏览器并删除其临时 profile, 释放名额后补充预热浏览器。"""
+        lease = self._leases.pop(key, None)
+        self._key_locks.pop(key, None)
+        if lease is None:
+            return
+        try:
+            await self._dispose(lease.browser)
+        finally:
+            async with self._cond:
+                self._num_browsers -= 1
+                self._cond.notify_all()
+            self._schedule_warm()
+
+    async def close_all(self):
+        """释放所有浏览器 (含预热的), 并停止后台任务。"""
+        tasks = [task for task in [self._reaper, *self._warming] if task is not None]
+        for task in tasks:
+            task.cancel()
+        # 等待被取消的预热任务清理完正在启动的浏览器, 避免遗留临时 profile
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._reaper = None
+        self._warming.clear()
+        for key in list(self._leases):
+            await self.release(key)
+        warm, self._warm = self._warm, []
+        for browser in warm:
+            await self._dispose(browser)
+        self._num_browsers = 0
+
+    def _ensure_background_tasks(self):
+        if self.idle_timeout and (self._reaper is None or self._reaper.done()):
+            self._reaper = asyncio.create_task(self._reap_idle())
+        self._schedule_warm()
+
+    def _schedule_warm(self):
+        """按 warm_browsers 补足预热浏览器, 占用名额但不超过 max_browsers。"""
+        while len(self._warm) + len(self._warming) < self.warm_browsers and self._num_browsers < self.max_browsers:
+            self._num_browsers += 1
+            task = asyncio.create_task(self._start_warm())
+            self._warming.add(task)
+            task.add_done_callback(self._warming.discard)
+
+    async def _start_warm(self):
+        browser = self._new_browser()
+        try:
+            await browser.start()
+        except BaseException as e:
+            if not isinstance(e, asyncio.CancelledError):
+                print(f"[SYSTEM WARNING][BROWSER] ⚠️ Failed to pre-start a browser: {e}")
+            await self._dispose(browser)
+            async with self._cond:
+                self._num_browsers -= 1
+                self._cond.notify_all()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return
+        async with self._cond:
+            self._warm.append(browser)
+            self._cond.notify_all()
+
+    async def _reap_idle(self):
+        """定期回收超过 idle_timeout 未被使用的浏览器; 正在分配或正在执行动作 (持有 browser.lock) 的浏览器不会被回收。"""
+        while True:
+            await asyncio.sleep(min(60, self.idle_timeout / 2))
+            now = time.monotonic()
+            for key, lease in list(self._leases.items()):
+                lock = self._key_locks.get(key)
+                if now - lease.last_used <= self.idle_timeout or (lock and lock.locked()) or lease.browser.lock.locked():
+                    continue
+                await self.release(key)
 
 # ========================================================================= #
 #  UTILS
 # ========================================================================= #
 def flatten_axtree_to_str(axtree, ignored_roles=None, depth=0, node_idx=0):
-    """递归地将可访问性树展开为字符串, 方便调试查看节点层级信息。"""
+    """
+    将可访问性树展开为字符串, 方便调试查看节点层级信息。
+    先一次性建立 nodeId -> 下标 的索引, 再用显式栈做前序遍历并写入列表后 join,
+    整体为 O(n), 且不会因 DOM 过深触发递归上限。被忽略的节点不输出自身, 其子节点保持在同一深度。
+    """
     if ignored_roles is None:
         ignored_roles = {"none"}
 
     nodes = axtree["nodes"]
-    node = nodes[node_idx]
-
-    role = node.get("role", {}).get("value", "")
-    name = node.get("name", {}).get("value", "")
-
-    if node.get("ignored", False) or role in ignored_roles:
-        children_str = ""
-        for child_id in node.get("childIds", []):
-            child_idx = next((i for i, n in enumerate(nodes) if n["nodeId"] == child_id), None)
+    index_of = {}
+    for i, n in enumerate(nodes):
+        index_of.setdefault(n["nodeId"], i)
+
+    lines = []
+    stack = [(node_idx, depth)]
+    while stack:
+        idx, cur_depth = stack.pop()
+        node = nodes[idx]
+
+        role = node.get("role", {}).get("value", "")
+        child_depth = cur_depth
+        if not (node.get("ignored", False) or role in ignored_roles):
+            name = node.get("name", {}).get("value", "")
+            props = []
+            for prop in node.get("properties", []):
+                p_name = prop.get("name", "")
+                p_val_dict = prop.get("value")
+                if p_val_dict is not None:
+                    if isinstance(p_val_dict, dict) and "value" in p_val_dict:
+                        p_value = p_val_dict["value"]
+                    else:
+                        p_value = p_val_dict
+                else:
+                    p_value = None
+                props.append(f"{p_name}={repr(p_value)}")
+            prop_str = (", " + ", ".join(props)) if props else ""
+            lines.append(f"{'    ' * cur_depth}{role} {repr(name)}{prop_str}\n")
+            child_depth = cur_depth + 1
+
+        # 逆序压栈, 保证子节点按原顺序输出
+        for child_id in reversed(node.get("childIds", [])):
+            child_idx = index_of.get(child_id)
             if child_idx is not None:
-                children_str += flatten_axtree_to_str(axtree, ignored_roles, depth, child_idx)
-        return children_str
-
-    indent = "    " * depth
-
-    props = []
-    for prop in node.get("properties", []):
-        p_name = prop.get("name", "")
-        p_val_dict = prop.get("value")
-        if p_val_dict is not None:
-            if isinstance(p_val_dict, dict) and "value" in p_val_dict:
-                p_value = p_val_dict["value"]
-            else:
-                p_value = p_val_dict
+                stack.append((child_idx, child_depth))
+
+    return "".join(lines)
+
+
+# 可访问性树裁剪时使用的角色分类
+AXTREE_DECORATIVE_ROLES = {"InlineTextBox", "LineBreak", "none", "presentation", "Canvas", "image"}
+AXTREE_WRAPPER_ROLES = {"generic", "group", "Section", "div", "paragraph", "LayoutTable", "LayoutTableRow", "LayoutTableCell"}
+AXTREE_INTERACTIVE_ROLES = {
+    "link", "button", "textbox", "searchbox", "combobox", "checkbox", "radio", "menuitem", "menuitemcheckbox",
+    "menuitemradio", "tab", "option", "switch", "slider", "spinbutton", "listbox", "treeitem", "MenuListPopup"
+}
+AXTREE_REPEATED_ROLES = {"row", "listitem", "option", "treeitem", "article", "gridcell", "cell", "menuitem"}
+
+
+@dataclass
+class _AxLine:
+    depth: int
+    role: str
+    name: str
+    text: str
+    parent: int
+    keep: bool = True
+    elided_note: str = ""
+
+
+def _parse_axtree_lines(text: str) -> list[_AxLine]:
+    """将 flatten_axtree_to_str 的输出还原为带父指针的行列表 (每级缩进 4 个空格)。"""
+    nodes: list[_AxLine] = []
+    stack: list[int] = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        stripped = line.lstrip(" ")
+        depth = (len(line) - len(stripped)) // 4
+        role, _, rest = stripped.partition(" ")
+        name_match = re.match(r"('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\")", rest)
+        name = name_match.group(1)[1:-1] if name_match else ""
+        while stack and nodes[stack[-1]].depth >= depth:
+            stack.pop()
+        nodes.append(_AxLine(depth=depth, role=role, name=name, text=stripped, parent=stack[-1] if stack else -1))
+        stack.append(len(nodes) - 1)
+    return nodes
+
+
+def _render_axtree_lines(nodes: list[_AxLine]) -> str:
+    """按保留标记重新输出, 被折叠的祖先不占缩进层级。"""
+    out = []
+    for i, node in enumerate(nodes):
+        if not node.keep and not node.elided_note:
+            continue
+        depth = 0
+        p = node.parent
+        while p != -1:
+            if nodes[p].keep:
+                depth += 1
+            p = nodes[p].parent
+        if node.keep:
+            out.append("    " * depth + node.text)
+        if node.elided_note:
+            out.append("    " * (depth + (1 if node.keep else 0)) + node.elided_note)
+    return "\n".join(out) + "\n"
+
+
+def prune_axtree_str(text: str, token_budget: int, max_name_len: int = 200, max_similar_siblings: int = 5) -> str:
+    """
+    将已展开的可访问性树裁剪到约 token_budget 个 token 以内, 逐级加大力度, 达标即停止:
+      1. 折叠装饰性/无名包裹节点, 删除与父节点同名的 StaticText, 截断过长的名称;
+      2. 折叠重复的同级行 (表格行、列表项等), 每组仅保留前 max_similar_siblings 个;
+      3. 从页面末尾开始丢弃非交互节点 (可交互或获得焦点的节点及其祖先始终保留), 满足预算即停止;
+      4. 仍超出时按行截断尾部。
+    每一步省略的内容都会在原位置或头部注明, 方便模型按需用其他工具进一步查看。
+    """
+    if estimate_tokens(text) <= token_budget:
+        return text
+
+    nodes = _parse_axtree_lines(text)
+    notes = []
+
+    # Stage 1: decorative roles, anonymous wrappers, redundant text and long names
+    collapsed = truncated = 0
+    for node in nodes:
+        parent_name = nodes[node.parent].name if node.parent != -1 else None
+        if node.role in AXTREE_DECORATIVE_ROLES or (node.role in AXTREE_WRAPPER_ROLES and not node.name):
+            node.keep = False
+            collapsed += 1
+        elif node.role == "StaticText" and parent_name is not None and node.name == parent_name:
+            node.keep = False
+            collapsed += 1
+        elif len(node.name) > max_name_len:
+            node.text = node.text.replace(node.name, node.name[:max_name_len] + "…[truncated]", 1)
+            truncated += 1
+    notes.append(f"{collapsed} decorative/redundant nodes collapsed, {truncated} long names truncated")
+    pruned = _render_axtree_lines(nodes)
+
+    # Stage 2: collapse runs of repeated siblings, keeping the ones that are focused
+    if estimate_tokens(pruned) > token_budget:
+        children: dict[int, list[int]] = {}
+        for i, node in enumerate(nodes):
+            children.setdefault(node.parent, []).append(i)
+        focused = {i for i, node in enumerate(nodes) if "focused=True" in node.text}
+        focused_with_ancestors = set()
+        for i in focused:
+            while i != -1 and i not in focused_with_ancestors:
+                focused_with_ancestors.add(i)
+                i = nodes[i].parent
+
+        def _drop_subtree(root: int):
+            todo = [root]
+            while todo:
+                j = todo.pop()
+                nodes[j].keep = False
+                todo.extend(children.get(j, []))
+
+        elided_rows = 0
+        for parent, kids in children.items():
+            by_role: dict[str, list[int]] = {}
+            for k in kids:
+                if nodes[k].role in AXTREE_REPEATED_ROLES:
+                    by_role.setdefault(nodes[k].role, []).append(k)
+            for role, group in by_role.items():
+                extra = [k for k in group[max_similar_siblings:] if k not in focused_with_ancestors]
+                if not extra:
+                    continue
+                for k in extra:
+                    _drop_subtree(k)
+                nodes[extra[-1]].elided_note = f"[... {len(extra)} more '{role}' items elided ...]"
+                elided_rows += len(extra)
+        notes.append(f"{elided_rows} repeated rows/items elided")
+        pruned = _render_axtree_lines(nodes)
+
+    # Stage 3: keep only interactive/focused nodes and their ancestors
+    if estimate_tokens(pruned) > token_budget:
+        important = set()
+        for i, node in enumerate(nodes):
+            if node.keep and (node.role in AXTREE_INTERACTIVE_ROLES or "focused=True" in node.text):
+                j = i
+                while j != -1 and j not in important:
+                    important.add(j)
+                    j = nodes[j].parent
+        candidates = [i for i, node in enumerate(nodes)
+                      if node.keep and i not in important and node.role not in ("RootWebArea", "heading")]
+        # 从页面末尾开始逐个丢弃, 按估算的节省量累计, 一旦满足预算即停止, 尽量保留正文而不是只剩交互节点
+        excess = estimate_tokens(pruned) - token_budget
+        dropped = 0
+        for i in reversed(candidates):
+            if excess <= 0:
+                break
+            node = nodes[i]
+            node.keep = False
+            excess -= estimate_tokens("    " * node.depth + node.text) + 1
+            if node.elided_note:
+                excess -= estimate_tokens(node.elided_note) + 1
+                node.elided_note = ""
+            dropped += 1
+        notes.append(f"{dropped} non-interactive nodes dropped from the end of the page")
+        pruned = _render_axtree_lines(nodes)
+
+    # Stage 4: hard cut at the budget (leaving room for the header)
+    if estimate_tokens(pruned) > token_budget:
+        lines = pruned.splitlines()
+        kept, used = [], 100
+        for line in lines:
+            used += estimate_tokens(line) + 1
+            if used > token_budget:
+                break
+            kept.append(line)
+        notes.append(f"{len(lines) - len(kept)} trailing lines cut")
+        pruned = "\n".join(kept) + "\n"
+
+    header = (f"[SYSTEM INFO: Accessibility tree pruned to fit ~{token_budget} tokens: " + "; ".join(notes) + ". "
+              "Use `browser_extract_content_by_vision` or scroll if you need the elided content.]\n")
+    return header + pruned
+
+
+def _axtree_anchor(lines: list[str], index: int) -> str:
+    """向前查找缩进更浅的最近一行, 即第 index 行所在子树的父节点, 作为稳定锚点。"""
+    if index >= len(lines):
+        index = len(lines) - 1
+    if index < 0:
+        return "(top of the tree)"
+    indent = len(lines[index]) - len(lines[index].lstrip(" "))
+    for i in range(index - 1, -1, -1):
+        line = lines[i]
+        if len(line) - len(line.lstrip(" ")) < indent:
+            return line.strip()
+    return "(top of the tree)"
+
+
+def diff_axtree_str(prev: str, cur: str, max_ratio: float = 0.3) -> str | None:
+    """
+    计算两棵已展开可访问性树之间的结构化增量: 按变化块输出被删除 (-) / 新增 (+) 的子树行, 并以父节点作为锚点。
+    两者完全相同时返回简短提示; 变化行数超过当前树行数的 max_ratio 时返回 None, 由调用方回退为完整树。
+    """
+    prev_lines = prev.splitlines()
+    cur_lines = cur.splitlines()
+    if prev_lines == cur_lines:
+        return "[SYSTEM INFO: The accessibility tree is unchanged since the last full tree shown above.]"
+
+    matcher = difflib.SequenceMatcher(None, prev_lines, cur_lines, autojunk=False)
+    hunks = []
+    changed = 0
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        changed += (i2 - i1) + (j2 - j1)
+        if changed > max_ratio * max(len(cur_lines), 1):
+            return None
+        if i1 < i2:
+            anchor = _axtree_anchor(prev_lines, i1)
         else:
-            p_value = None
-        props.append(f"{p_name}={repr(p_value)}")
-    prop_str = (", " + ", ".join(props)) if props else ""
-
-    s = f"{indent}{role} {repr(name)}{prop_str}\n"
-
-    for child_id in node.get("childIds", []):
-        child_idx = next((i for i, n in enumerate(nodes) if n["nodeId"] == child_id), None)
-        if child_idx is not None:
-            s += flatten_axtree_to_str(axtree, ignored_roles, depth+1, child_idx)
-    return s
+            anchor = _axtree_anchor(cur_lines, j1)
+        hunk = [f"@@ under: {anchor}"]
+        hunk.extend(f"- {line}" for line in prev_lines[i1:i2])
+        hunk.extend(f"+ {line}" for line in cur_lines[j1:j2])
+        hunks.append("\n".join(hunk))
+
+    return (
+        "[SYSTEM INFO: Incremental update. Only the subtrees that changed since the last full accessibility tree are shown "
+        "('-' removed, '+' added, each block anchored under its parent node); everything else is unchanged. "
+        "Use `browser_wait_and_get_update` to get the full tree again.]\n"
+        + "\n".join(hunks)
+    )
+
+
+if __name__ == "__main__":
+    # 微基准: python browser.py [recorded_axtree.json ...]
+    # 录制文件为 CDP `Accessibility.getFullAXTree` 的原始返回 ({"nodes": [...]}); 未提供时生成一棵合成的大树。
+    import sys
+    import random
+
+    def synthetic_axtree(num_nodes: int = 20000, fanout: int = 8) -> dict:
+        roles = ["generic", "link", "button", "StaticText", "row", "cell", "none", "heading"]
+        nodes = [{"nodeId": "0", "role": {"value": "RootWebArea"}, "name": {"value": "root"}, "childIds": []}]
+        for i in range(1, num_nodes):
+            parent = nodes[(i - 1) // fanout]
+            parent["childIds"].append(str(i))
+            nodes.append({
+                "nodeId": str(i),
+                "ignored": random.random() < 0.1,
+                "role": {"value": random.choice(roles)},
+                "name": {"value": f"node {i}"},
+                "properties": [{"name": "focusable", "value": {"type": "boolean", "value": i % 5 == 0}}],
+                "childIds": []
+            })
+        rest = nodes[1:]
+        random.shuffle(rest)
+        return {"nodes": nodes[:1] + rest}
+
+    trees = {}
+    for tree_path in sys.argv[1:]:
+        with open(tree_path, "r", encoding="utf-8") as f:
+            trees[tree_path] = json.load(f)
+    if not trees:
+        random.seed(0)
+        trees["synthetic-20000"] = synthetic_axtree()
+
+    for label, tree in trees.items():
+        repeat = 5
+        st = time.perf_counter()
+        for _ in range(repeat):
+            text = flatten_axtree_to_str(tree)
+        cost = (time.perf_counter() - st) / repeat
+        print(f"{label}: {len(tree['nodes'])} nodes -> {len(text)} chars, {cost * 1000:.2f} ms/flatten")
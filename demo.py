@@ -3,6 +3,8 @@ import os
 import sys
 import asyncio
 
+from model import LLM
+from tool import ToolRegistry
 from agent import MUSE
 from prompt.system_prompt import MUSE_sys_prompt
 
@@ -36,6 +38,8 @@ async def main():
     )
 
     await agent.run(task, subtask_action_limit=20)
+    await ToolRegistry.aclose_all()
+    await LLM.aclose_all()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,313 @@
+import sys
+import json
+import asyncio
+import traceback
+from typing import AsyncGenerator, Optional
+
+from utils import HeadTailBuffer, kill_process_group
+
+# ============================================================================
+# 常驻 Python 内核
+# ============================================================================
+# 默认情况下 python 工具每次都会启动一个新的解释器执行临时脚本, 需要重新 import
+# pandas/openpyxl 等依赖, 且变量无法跨动作保留。PythonKernel 维护一个长期存活的
+# worker 子进程, 通过管道收发 JSON 行协议:
+#   父进程 -> worker (stdin):   {"op": "exec", "code": ...} / {"op": "reset"}
+#   worker -> 父进程 (stdout): {"type": "stream", "name": "stdout"|"stderr", "text": ...}
+#                              {"type": "done", "ok": bool, "returncode": int | None}
+# worker 会把原始 fd 1 重定向到一个内部管道, 由后台线程转发为 stdout 分片; 因此用户代码中启动的子进程
+# (os.system、未捕获输出的 subprocess.run) 直接写 fd 1 既不会污染协议流, 也与一次性解释器模式一样记为 stdout。
+# 每次执行结束前 worker 会向 fd 1 写入同步标记并等待转发线程读到它, 保证子进程输出先于 done 到达。
+
+STATUS_EXECUTED = "CODE_EXECUTED"
+STATUS_FAILURE_TIMEOUT = "TOOL_FAILURE_TIMEOUT"
+STATUS_FAILURE_CRASHED = "TOOL_FAILURE_KERNEL_CRASHED"
+STATUS_FAILURE_EXCEPTION = "TOOL_FAILURE_UNKNOWN_EXCEPTION"
+
+WORKER_SOURCE = r'''
+import os
+import sys
+import json
+import codecs
+import builtins
+import threading
+import traceback
+
+work_dir = sys.argv[1]
+proto = os.fdopen(os.dup(1), "w", encoding="utf-8", buffering=1)
+fd1_read, fd1_write = os.pipe()
+os.dup2(fd1_write, 1)
+os.close(fd1_write)
+commands = sys.stdin
+sys.stdin = open(os.devnull, "r")
+send_lock = threading.Lock()
+FD1_SYNC = b"\x00muse-fd1-sync\x00"
+fd1_synced = threading.Event()
+
+
+def send(message):
+    with send_lock:
+        proto.write(json.dumps(message, ensure_ascii=False) + "\n")
+        proto.flush()
+
+
+class StreamProxy:
+    def __init__(self, name):
+        self.name = name
+
+    def write(self, text):
+        for i in range(0, len(text), 4096):
+            send({"type": "stream", "name": self.name, "text": text[i:i + 4096]})
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+sys.stdout = StreamProxy("stdout")
+sys.stderr = StreamProxy("stderr")
+
+
+def pump_fd1():
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    proxy = StreamProxy("stdout")
+    pending = b""
+    while True:
+        data = os.read(fd1_read, 65536)
+        if not data:
+            break
+        pending += data
+        while FD1_SYNC in pending:
+            before, pending = pending.split(FD1_SYNC, 1)
+            proxy.write(decoder.decode(before))
+            fd1_synced.set()
+        cut = pending.rfind(b"\x00")
+        held = b""
+        if cut >= 0 and FD1_SYNC.startswith(pending[cut:]):
+            pending, held = pending[:cut], pending[cut:]
+        text = decoder.decode(pending)
+        if text:
+            proxy.write(text)
+        pending = held
+
+
+def sync_fd1():
+    fd1_synced.clear()
+    try:
+        os.write(1, FD1_SYNC)
+    except OSError:
+        return
+    fd1_synced.wait(5)
+
+
+threading.Thread(target=pump_fd1, daemon=True).start()
+
+
+def fresh_namespace():
+    return {"__name__": "__main__", "__builtins__": builtins}
+
+
+namespace = fresh_namespace()
+for line in commands:
+    request = json.loads(line)
+    if request["op"] == "reset":
+        namespace = fresh_namespace()
+        os.chdir(work_dir)
+        send({"type": "done", "ok": True, "returncode": 0})
+        continue
+
+    ok, returncode = True, 0
+    try:
+        exec(compile(request["code"], "<code>", "exec"), namespace)
+    except SystemExit as e:
+        returncode = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        ok = returncode == 0
+    except BaseException as e:
+        traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+        ok, returncode = False, 1
+    sync_fd1()
+    send({"type": "done", "ok": ok, "returncode": returncode})
+'''
+
+
+class PythonKernel:
+    """长期存活的 Python worker, 在同一任务的多次 python 动作之间保留 import 与变量状态。"""
+
+    def __init__(
+            self,
+            work_dir: str = "/workspace",
+            timeout: float = 270,
+            memory_limit_mb: Optional[int] = 8192,
+            max_output_length: int = 65536
+    ):
+        self.work_dir = work_dir
+        self.timeout = timeout
+        self.memory_limit_mb = memory_limit_mb
+        self.max_output_length = max_output_length
+
+        self.proc: Optional[asyncio.subprocess.Process] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._readers = []
+        self._lock = asyncio.Lock()
+        self.restarts = 0
+
+    @property
+    def is_alive(self) -> bool:
+        return self.proc is not None and self.proc.returncode is None
+
+    def _limit_resources(self):
+        """在子进程中执行 (preexec_fn), 为 worker 设置虚拟内存上限。"""
+        if self.memory_limit_mb:
+            import resource
+            limit = self.memory_limit_mb * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    async def start(self):
+        """启动 worker 子进程, 并开启协议流与 stderr 的后台读取任务。"""
+        self.proc = await asyncio.create_subprocess_exec(
+            sys.executable, "-u", "-c", WORKER_SOURCE, self.work_dir,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            cwd=self.work_dir, start_new_session=True, preexec_fn=self._limit_resources, limit=2 ** 20
+        )
+        self._queue = asyncio.Queue()
+        self._readers = [
+            asyncio.create_task(self._read_protocol(self.proc.stdout, self._queue)),
+            asyncio.create_task(self._read_stderr(self.proc.stderr, self._queue))
+        ]
+
+    @staticmethod
+    async def _read_protocol(stream: asyncio.StreamReader, queue: asyncio.Queue):
+        while True:
+            line = await stream.readline()
+            if not line:
+                break
+            try:
+                await queue.put(json.loads(line))
+            except json.JSONDecodeError:
+                await queue.put({"type": "stream", "name": "stderr", "text": line.decode("utf-8", errors="replace")})
+        await queue.put({"type": "eof"})
+
+    @staticmethod
+    async def _read_stderr(stream: asyncio.StreamReader, queue: asyncio.Queue):
+        while True:
+            data = await stream.read(4096)
+            if not data:
+                break
+            await queue.put({"type": "stream", "name": "stderr", "text": data.decode("utf-8", errors="replace")})
+
+    async def _send(self, request: dict):
+        self.proc.stdin.write((json.dumps(request, ensure_ascii=False) + "\n").encode("utf-8"))
+        await self.proc.stdin.drain()
+
+    async def _ensure_started(self) -> bool:
+        """worker 不存在或已崩溃时 (重新) 启动, 返回是否发生了重启。"""
+        if self.is_alive:
+            return False
+        restarted = self.proc is not None
+        await self.shutdown()
+        await self.start()
+        if restarted:
+            self.restarts += 1
+        return restarted
+
+    async def reset(self):
+        """清空用户命名空间但保留已导入的模块, 用于在子任务之间隔离变量。"""
+        async with self._lock:
+            if not self.is_alive:
+                return
+            try:
+                await self._send({"op": "reset"})
+                while True:
+                    message = await asyncio.wait_for(self._queue.get(), self.timeout)
+                    if message["type"] in ("done", "eof"):
+                        break
+            except Exception:
+                await self.shutdown()
+
+    async def run(self, code: str) -> AsyncGenerator[dict, None]:
+        """
+        在常驻 worker 中执行代码, 输出协议与 BaseAgent.python_interpreter 一致:
+        逐段输出作为 progress 分片产出, 最后一个分片为 JSON 结果。超时会杀死并在下次调用时重启 worker。
+        """
+        outputs = {"stdout": HeadTailBuffer(self.max_output_length), "stderr": HeadTailBuffer(self.max_output_length)}
+        notes = []
+        result = None
+
+        async with self._lock:
+            try:
+                if await self._ensure_started():
+                    notes.append("The Python kernel was restarted after a previous timeout, crash or interrupted call, all variables and imports were lost.")
+
+                await self._send({"op": "exec", "code": code})
+                deadline = asyncio.get_running_loop().time() + self.timeout
+                done = None
+                while done is None:
+                    remaining = deadline - asyncio.get_running_loop().time()
+                    if remaining <= 0:
+                        raise asyncio.TimeoutError()
+                    message = await asyncio.wait_for(self._queue.get(), remaining)
+                    if message["type"] == "stream":
+                        outputs[message["name"]].append(message["text"])
+                        yield {"data": message["text"], "instruction": "", "progress": True}
+                    else:
+                        done = message
+
+                if done["type"] == "eof":
+                    await self.shutdown()
+                    result = {
+                        "execution_status": STATUS_FAILURE_CRASHED,
+                        "stdout": outputs["stdout"].getvalue().strip(),
+                        "stderr": (outputs["stderr"].getvalue().strip() + "\n"
+                                   "The Python kernel process exited unexpectedly (e.g. out of memory). "
+                                   "It will be restarted on the next call, all variables and imports were lost.").strip()
+                    }
+                else:
+                    result = {
+                        "execution_status": STATUS_EXECUTED,
+                        "code_result": {
+                            "returncode": done["returncode"],
+                            "stdout_truncated": outputs["stdout"].truncated,
+                            "stderr_truncated": outputs["stderr"].truncated
+                        },
+                        "stdout": outputs["stdout"].getvalue().strip(),
+                        "stderr": outputs["stderr"].getvalue().strip()
+                    }
+
+            except asyncio.TimeoutError:
+                await self.shutdown()
+                result = {
+                    "execution_status": STATUS_FAILURE_TIMEOUT,
+                    "stdout": outputs["stdout"].getvalue().strip(),
+                    "stderr": (outputs["stderr"].getvalue().strip() + "\n"
+                               f"Code execution timed out (terminated after {self.timeout} seconds). "
+                               "The Python kernel has been restarted, all variables and imports were lost.").strip()
+                }
+
+            except Exception:
+                await self.shutdown()
+                result = {
+                    "execution_status": STATUS_FAILURE_EXCEPTION,
+                    "exception": traceback.format_exc()
+                }
+
+            finally:
+                # 调用被取消或生成器被提前关闭 (Ctrl-C、并行反思取消其他分支) 时 worker 可能仍在执行旧代码,
+                # 其剩余输出与 done 会被下一次调用误读; 直接杀掉 worker, 下次调用重启并附带重启说明。
+                if result is None:
+                    await self.shutdown()
+
+        if notes:
+            result["kernel_notes"] = notes
+        yield {"data": json.dumps(result, ensure_ascii=False, indent=2), "instruction": ""}
+
+    async def shutdown(self):
+        """杀死 worker 所在进程组并回收后台读取任务。"""
+        if self.proc is not None and self.proc.returncode is None:
+            kill_process_group(self.proc)
+            await self.proc.wait()
+        for reader in self._readers:
+            reader.cancel()
+        self._readers = []
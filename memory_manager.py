@@ -5,18 +5,22 @@ from pathlib import Path
 from dataclasses import asdict
 from typing import Dict, Any, Tuple, List
 
-from model import LLM
+from model import LLM, PROMPT_CACHE_CONFIG, HISTORY_BUDGET_CONFIG
 from log import AgentLogger
 from monitor import Monitor
+from retrieval import BM25Index
 from prompt.system_prompt import sys_memory_prompt_template
 from utils import remove_accessibility_tree_in_the_history, remove_browser_state_in_the_history, \
-    create_message, deep_update, dict_to_outline_str, pretty_print_trajectory, remove_python_code_in_the_history
+    create_message, deep_update, dict_to_outline_str, pretty_print_trajectory, remove_python_code_in_the_history, Trajectory, Message, message_to_json, estimate_messages_tokens
 
 
 class MemoryManager:
     """管理智能体的长期记忆, 负责读取/写入经验并动态拼装系统提示词。"""
 
-    def __init__(self, memory_dir: str, logger: AgentLogger, output_dir: Path, sys_prompt_template: str, tool_schema_texts: str, use_memory: bool = True):
+    # 进程内的应用记忆版本号, 每次写回 procedural_memory.json 时递增, 供 memory_tool 判断缓存的指南是否需要重新加载。
+    APP_MEMORY_VERSION = 0
+
+    def __init__(self, memory_dir: str, logger: AgentLogger, output_dir: Path, sys_prompt_template: str, tool_schema_texts: str, use_memory: bool = True, retrieval_top_k: int = None):
         self.memory_dir = Path(memory_dir)
         self.logger = logger
         self.output_dir: Path = output_dir
@@ -24,14 +28,37 @@ class MemoryManager:
         self.tool_schema_texts = tool_schema_texts
         self.use_memory = use_memory
 
-        self.history: List[dict] = []
-
-        self.tool_enhance_dict: Dict[str, Any] = self._load_memory(self.memory_dir / "tool_memory.json")
-        self.application_enhance_dict: Dict[str, Any] = self._load_memory(self.memory_dir / "procedural_memory.json")
-        self.methodology_enhance_dict: Dict[str, Any] = self._load_memory(self.memory_dir / "strategic_memory.json")
-
-        self.app_guide_str = dict_to_outline_str(self.application_enhance_dict)
-        self.metho_guide_str = dict_to_outline_str(self.methodology_enhance_dict)
+        self.history: List[Message] = []
+        # 开启 prompt_cache 时, 超出保留窗口的轮次按 trim_checkpoint 轮一组批量裁剪, 两次裁剪之间请求前缀只追加不改写,
+        # 服务端前缀缓存得以命中; 未开启时为 1, 即每轮都裁剪 (原有行为)。
+        self.trim_checkpoint: int = max(1, int(PROMPT_CACHE_CONFIG.get("trim_checkpoint", 4))) if PROMPT_CACHE_CONFIG.get("enabled", False) else 1
+
+        # 记忆字典通过 property 访问, 替换时自动刷新指南字符串; memory_version 只在注入系统提示词的内容变化时递增,
+        # update_system_prompt 据此跳过重复渲染, 系统消息对象在内容不变时保持不变 (利于服务端的前缀缓存)。
+        self.memory_version = 0
+        self._prompt_version = -1
+        self._system_message: Message | None = None
+        # add_traj 记录的子任务分段 (首条消息, 消息数), 超出 history_budget 时最旧的分段被替换为摘要
+        self._segments: List[Tuple[Message, int]] = []
+        self._warned_no_memory = False
+        self.app_guide_str = ""
+        self.metho_guide_str = ""
+
+        self._tool_enhance_dict: Dict[str, Any] = self._load_memory(self.memory_dir / "tool_memory.json")
+        self._application_enhance_dict: Dict[str, Any] = self._load_memory(self.memory_dir / "procedural_memory.json")
+        self._methodology_enhance_dict: Dict[str, Any] = self._load_memory(self.memory_dir / "strategic_memory.json")
+
+        # retrieval_top_k 为 None 时系统提示词注入完整的指南目录; 否则只注入与当前任务/子任务最相关的 top-k 条目,
+        # 条目由持久化在记忆文件旁的 BM25 索引检索, 提示词长度不再随程序性记忆增长。
+        self.retrieval_top_k = retrieval_top_k
+        self.retrieval_query = ""
+        self.app_index: BM25Index | None = None
+        if retrieval_top_k is not None:
+            self.app_index = BM25Index.load(self.memory_dir / "procedural_index.json")
+            if self.app_index.sync(self.application_enhance_dict):
+                self.app_index.save(self.memory_dir / "procedural_index.json")
+
+        self._refresh_guides()
 
         def _memory_loading_log(items: List[tuple]):
             for content, title in items:
@@ -45,6 +72,42 @@ class MemoryManager:
 
         self.update_system_prompt()
 
+    @property
+    def tool_enhance_dict(self) -> Dict[str, Any]:
+        return self._tool_enhance_dict
+
+    @tool_enhance_dict.setter
+    def tool_enhance_dict(self, value: Dict[str, Any]):
+        # 工具记忆不进入系统提示词 (在 call_tool 中作为 tool_instruction 附加), 无需刷新
+        self._tool_enhance_dict = value
+
+    @property
+    def application_enhance_dict(self) -> Dict[str, Any]:
+        return self._application_enhance_dict
+
+    @application_enhance_dict.setter
+    def application_enhance_dict(self, value: Dict[str, Any]):
+        self._application_enhance_dict = value
+        self._refresh_guides()
+
+    @property
+    def methodology_enhance_dict(self) -> Dict[str, Any]:
+        return self._methodology_enhance_dict
+
+    @methodology_enhance_dict.setter
+    def methodology_enhance_dict(self, value: Dict[str, Any]):
+        self._methodology_enhance_dict = value
+        self._refresh_guides()
+
+    def _refresh_guides(self):
+        """重新渲染指南字符串, 内容变化时递增 memory_version。原地修改记忆字典后也需调用。"""
+        app_guide_str = self._render_app_guide()
+        metho_guide_str = dict_to_outline_str(self.methodology_enhance_dict)
+        if app_guide_str != self.app_guide_str or metho_guide_str != self.metho_guide_str:
+            self.app_guide_str = app_guide_str
+            self.metho_guide_str = metho_guide_str
+            self.memory_version += 1
+
     @staticmethod
     def _load_memory(memory_path: Path) -> dict:
         """从磁盘读取 JSON 记忆文件, 失败时返回空字典。"""
@@ -78,8 +141,35 @@ class MemoryManager:
             print(f"Failed to save memory to {memory_path}: {e}")
             traceback.print_exc()
 
+    def _render_app_guide(self) -> str:
+        """渲染注入系统提示词的指南目录: 未开启检索时为完整目录, 否则为检索出的 top-k 条目。"""
+        if self.app_index is None:
+            return dict_to_outline_str(self.application_enhance_dict)
+
+        selected: Dict[str, List[str]] = {}
+        for _, app, item in self.app_index.search(self.retrieval_query, self.retrieval_top_k):
+            selected.setdefault(app, []).append(item)
+        others = ", ".join(str(app) for app in self.application_enhance_dict if app not in selected)
+        if not others:
+            return dict_to_outline_str(selected)
+        hint = "Use `access_the_application_guide` with an `application_name` and no `item_names` to read all entries of an application."
+        if not selected:
+            return f"(Applications with guides: {others}. {hint})"
+        return (f"{dict_to_outline_str(selected)}\n"
+                f"(Entries most relevant to the current task are listed above. Other applications with guides: {others}. {hint})")
+
+    def set_retrieval_query(self, query: str):
+        """设置当前任务/子任务的检索查询并刷新指南目录, 未开启检索时不做任何事。"""
+        if self.app_index is None:
+            return
+        self.retrieval_query = query
+        self._refresh_guides()
+
     def update_system_prompt(self):
-        """根据记忆内容刷新系统提示词, 注入工具与经验指导。"""
+        """根据记忆内容刷新系统提示词, 注入工具与经验指导; 记忆未变化且系统消息仍在原位时直接复用。"""
+        if self._prompt_version == self.memory_version and self.history and self.history[0] is self._system_message:
+            return
+
         if self.use_memory:
             memory = sys_memory_prompt_template.format(
                 methodology=self.metho_guide_str,
@@ -90,25 +180,102 @@ class MemoryManager:
                 methodology="",
                 guidance="",
             )
-            self.logger.log_task("Pass the memory load step", subtitle="WARNING···", title="use_memory set to False")
-
-        system_prompt = self.sys_prompt_template.format(
-            memory=memory,
-            tools=self.tool_schema_texts
-        )
-        if not self.history or self.history[0]["role"] != "system":
-            self.history.insert(0, create_message("system", system_prompt))
+            if not self._warned_no_memory:
+                self.logger.log_task("Pass the memory load step", subtitle="WARNING···", title="use_memory set to False")
+                self._warned_no_memory = True
+
+        if self._prompt_version != self.memory_version or self._system_message is None:
+            system_prompt = self.sys_prompt_template.format(
+                memory=memory,
+                tools=self.tool_schema_texts
+            )
+            self._system_message = create_message("system", system_prompt)
+            self._prompt_version = self.memory_version
+        if not self.history or self.history[0].role != "system":
+            self.history.insert(0, self._system_message)
         else:
-            self.history[0] = create_message("system", system_prompt)
+            self.history[0] = self._system_message
 
     def add_turn(self, user_message: dict, assistant_message: dict):
         """追加一轮对话到历史记录, 方便后续上下文引用。"""
         self.history.extend([user_message, assistant_message])
 
-    def add_traj(self, trajectory: List[dict]):
+    def add_traj(self, trajectory: List[Message]):
         """将完整的执行轨迹拼接到记忆中, 便于反思阶段访问。"""
+        if trajectory:
+            self._segments.append((trajectory[0], len(trajectory)))
         self.history.extend(trajectory)
 
+    async def compact_history(self) -> int:
+        """
+        history 的估算 token 数超过 history_budget.max_tokens 时, 从最旧的子任务轨迹开始替换为摘要,
+        最近 keep_recent_subtasks 个子任务保持原样。原地修改 history (智能体持有同一列表), 返回被摘要的子任务数。
+        """
+        max_tokens = HISTORY_BUDGET_CONFIG.get("max_tokens")
+        if not max_tokens:
+            return 0
+        keep_recent = max(0, int(HISTORY_BUDGET_CONFIG.get("keep_recent_subtasks", 2)))
+        total = self.history_tokens()
+        compacted = 0
+        while total > max_tokens and len(self._segments) > keep_recent:
+            first, length = self._segments.pop(0)
+            start = next((i for i, m in enumerate(self.history) if m is first), None)
+            if start is None:
+                # 该分段已被其他操作移除 (如 rm_traj_by_length)
+                continue
+            segment = self.history[start:start + length]
+            summary = await self._summarize_segment(segment)
+            self.history[start:start + length] = summary
+            total += estimate_messages_tokens(summary) - estimate_messages_tokens(segment)
+            compacted += 1
+        if compacted:
+            self.logger.log_task(f"Summarized {compacted} earlier subtask trajectories, history is now ~{total} tokens.",
+                                 subtitle="HISTORY COMPACTED", title="Bounded History")
+        return compacted
+
+    async def _summarize_segment(self, segment: List[Message]) -> List[Message]:
+        """
+        将一个子任务轨迹压缩为两轮对话: (子任务目标, 行动与关键观察摘要) + 原样保留的最后一轮 (反思检查报告/失败分析)。
+        保持 user/assistant 交替, 首条 user 消息依旧是子任务目标。
+        """
+        if len(segment) < 4 or segment[0].role != "user" or segment[-1].role != "assistant":
+            return segment
+        steps, final_turn = segment[:-2], segment[-2:]
+        body = None
+        if HISTORY_BUDGET_CONFIG.get("summarizer", "rule") == "llm":
+            llm = LLM.get(HISTORY_BUDGET_CONFIG.get("summary_model", "gemini-2.5-flash"))
+            body = await llm.async_generate(
+                "Summarize the following subtask execution trajectory for later reference. Keep the actions taken, "
+                "key observations (values, file paths, URLs, errors) and the outcome; omit page dumps and code.\n\n"
+                + pretty_print_trajectory(steps, show_full_content=True, print_to_terminal=False),
+                max_tokens=2048,
+                call_site="history_summary"
+            )
+            if not body or not body.strip() or body.startswith("ERROR:"):
+                body = None
+        if body is None:
+            body = self._rule_summary(steps[1:], int(HISTORY_BUDGET_CONFIG.get("observation_chars", 300)))
+        return [
+            create_message("user", f"{steps[0].text}\n[SYSTEM INFO: The execution trajectory of this subtask was summarized to save context.]"),
+            create_message("assistant", body),
+            *final_turn
+        ]
+
+    @staticmethod
+    def _rule_summary(steps: List[Message], observation_chars: int) -> str:
+        """按规则生成摘要: 每个动作保留去掉代码块后的说明, 每个观察保留开头的片段。"""
+        def excerpt(text: str) -> str:
+            text = " ".join(text.split())
+            return text if len(text) <= observation_chars else text[:observation_chars] + " ..."
+
+        lines = ["* Summary of the earlier execution steps:"]
+        for msg in steps:
+            if msg.role == "assistant":
+                lines.append(f"- Action: {excerpt(remove_python_code_in_the_history(msg.text))}")
+            else:
+                lines.append(f"  Observation: {excerpt(msg.text)}")
+        return "\n".join(lines)
+
     def rm_traj_by_length(self, length: int, offset: int = 0):
         """按长度回退若干轮轨迹, 常用于失败重试时清理多余信息。"""
         if length > 0:
@@ -121,10 +288,14 @@ class MemoryManager:
         """向历史追加任意角色的信息, 用于插入系统提醒或人工反馈。"""
         self.history.append(create_message(role, content))
 
-    def get_history(self) -> List[dict]:
+    def get_history(self) -> List[Message]:
         """返回当前缓存的对话历史。"""
         return self.history
 
+    def history_tokens(self) -> int:
+        """对话历史的估算 token 数, 每条消息的估算值缓存在消息上, 不会重复计算。"""
+        return estimate_messages_tokens(self.history)
+
     @staticmethod
     def trim_traj(
             traj: list,
@@ -132,52 +303,70 @@ class MemoryManager:
             axtree: bool = True,
             state: bool = True,
             python: bool = True,
+            checkpoint: int = 1,
     ):
         """
         清理末尾的对话轮次, 仅保留 preserve_last 指定的若干轮; 同时可按需剔除可访问性树、浏览器状态或 Python 代码块。
+        checkpoint > 1 时只裁剪到 checkpoint 轮的整数倍边界, 使两次边界之间的请求前缀保持不变。
+        traj 为 Trajectory 时从其 trimmed_until 高水位继续, 每条消息只在移出保留窗口时被裁剪一次; 普通 list 则整体处理。
+        被裁剪的消息以新对象替换, 原消息不被修改, 所以可以先浅拷贝列表再裁剪, 无需 deepcopy。
         """
         if not isinstance(traj, list) or len(traj) < 2:
             return
 
         skip = preserve_last * 2
-        start = len(traj) - 1 - skip
-        if start < 1:
+        aged = len(traj) - skip
+        if checkpoint > 1:
+            aged -= aged % (2 * checkpoint)
+        done = getattr(traj, "trimmed_until", 0)
+        if aged <= done + 1:
             return
 
-        i = start
-        while i >= 1:
-            msg_a = traj[i]
+        for i in range(done + 1, aged, 2):
             msg_u = traj[i - 1]
+            msg_a = traj[i]
 
-            assert msg_u.get("role") == "user", f"role mismatch at index {i - 1}: expected user"
-            assert msg_a.get("role") == "assistant", f"role mismatch at index {i}: expected assistant"
+            assert msg_u.role == "user", f"role mismatch at index {i - 1}: expected user"
+            assert msg_a.role == "assistant", f"role mismatch at index {i}: expected assistant"
 
-            text_u = msg_u["content"][0]["text"]
+            # 写时复制: 只替换 traj 中的条目, 不修改消息本身, 因此与其他列表共享的完整消息保持不变。
+            text_u = msg_u.text
+            trimmed_u = text_u
             if axtree:
-                text_u = remove_accessibility_tree_in_the_history(text_u)
+                trimmed_u = remove_accessibility_tree_in_the_history(trimmed_u)
             if state:
-                text_u = remove_browser_state_in_the_history(text_u)
-            msg_u["content"][0]["text"] = text_u
+                trimmed_u = remove_browser_state_in_the_history(trimmed_u)
+            if trimmed_u != text_u:
+                traj[i - 1] = create_message("user", trimmed_u)
 
-            text_a = msg_a["content"][0]["text"]
+            text_a = msg_a.text
             if python:
-                text_a = remove_python_code_in_the_history(text_a)
-            msg_a["content"][0]["text"] = text_a
+                trimmed_a = remove_python_code_in_the_history(text_a)
+                if trimmed_a != text_a:
+                    traj[i] = create_message("assistant", trimmed_a)
 
-            i -= 2
+        if isinstance(traj, Trajectory):
+            traj.trimmed_until = done + (aged - done) // 2 * 2
 
     def update_and_save_app_memory(self, new_conclusion: dict):
         """将反思得到的应用经验融合到长期记忆, 并立即写回。"""
         self.logger.log_task(str(new_conclusion), subtitle="UPDATING······", title="Update App Memory")
         deep_update(self.application_enhance_dict, new_conclusion)
-        self.app_guide_str = dict_to_outline_str(self.application_enhance_dict)
         self._save_memory(self.memory_dir / "procedural_memory.json", self.application_enhance_dict)
+        MemoryManager.APP_MEMORY_VERSION += 1
+        if self.app_index is not None and self.app_index.sync(self.application_enhance_dict):
+            self.app_index.save(self.memory_dir / "procedural_index.json")
+        self._refresh_guides()
 
     def save_all_memory_to_disk(self):
         """在任务结束时统一落盘所有类型的记忆片段。"""
         self._save_memory(self.memory_dir / "tool_memory.json", self.tool_enhance_dict)
         self._save_memory(self.memory_dir / "procedural_memory.json", self.application_enhance_dict)
         self._save_memory(self.memory_dir / "strategic_memory.json", self.methodology_enhance_dict)
+        MemoryManager.APP_MEMORY_VERSION += 1
+        if self.app_index is not None and self.app_index.sync(self.application_enhance_dict):
+            self.app_index.save(self.memory_dir / "procedural_index.json")
+            self._refresh_guides()
 
     def save_run_artifacts(self, monitor: Monitor):
         """将运行轨迹、监控状态与 LLM 统计写入输出目录, 便于复盘。"""
@@ -199,13 +388,66 @@ class MemoryManager:
             }
         }
         with overall_state_output_path.open("w", encoding="utf-8") as f:
-            json.dump(overall_state, f, indent=4, ensure_ascii=False)
+            json.dump(overall_state, f, indent=4, ensure_ascii=False, default=message_to_json)
 
         with open(output_dir / "num_calls.txt", "w", encoding="utf-8") as f:
             f.write(str({
                 "num_calls": LLM.NUM_CALLS,
                 "prompt_tokens": LLM.PROMPT_TOKENS,
                 "completion_tokens": LLM.COMPLETION_TOKENS,
-                "max_tokens": LLM.MAX_TOKENS
+                "max_tokens": LLM.MAX_TOKENS,
+                "cache_hits": LLM.CACHE_HITS,
+                "cache_misses": LLM.CACHE_MISSES,
+                "saved_prompt_tokens": LLM.SAVED_PROMPT_TOKENS,
+                "saved_completion_tokens": LLM.SAVED_COMPLETION_TOKENS,
+                "cached_prompt_tokens": LLM.CACHED_PROMPT_TOKENS,
+                "call_site_tokens": LLM.CALL_SITE_TOKENS
             }))
 
+
+if __name__ == "__main__":
+    # 微基准: python memory_manager.py [num_actions] [axtree_lines]
+    # 模拟 exec_subtask 的 20 步浏览器 ReAct 循环: 每步先 trim_traj(preserve_last=3) 再发送 history + working_trajectory,
+    # 对比不裁剪 / 逐步全量裁剪 (普通 list) / 增量裁剪 (Trajectory) 的请求 token 总量与每次调用的裁剪耗时。
+    import sys
+    import time
+    import random
+    # 与 toolbox/browse_tool.py 的 tool_result_prompt 格式相同 (此处不导入, 以免依赖 browser_use)
+    tool_result_prompt = ("Performed browser action: {tool_result}\nThe updated browser page status is as follows:\n"
+                          "<webpage accessibility tree>\n{axtree}\n</webpage accessibility tree>\n"
+                          "<webpage interactive elements>\n{state}\n</webpage interactive elements>\n")
+
+    num_actions = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    axtree_lines = int(sys.argv[2]) if len(sys.argv) > 2 else 1500
+    random.seed(0)
+    roles = ["link", "button", "StaticText", "heading", "row", "cell", "textbox"]
+
+    def synthetic_observation(step: int) -> str:
+        axtree = "\n".join(f"{'    ' * random.randint(0, 6)}{random.choice(roles)} 'node {step}.{i}'" for i in range(axtree_lines))
+        state = "\n".join(f"[{i}]<a>item {step}.{i}</a>" for i in range(axtree_lines // 5))
+        return "Observation: \n" + tool_result_prompt.format(tool_result=f"Clicked element {step}", axtree=axtree, state=state)
+
+    observations = [synthetic_observation(step) for step in range(num_actions)]
+    actions = [f"Step {step}: click the next link.\n```python\nprint('inspect page {step}')\n```" for step in range(num_actions)]
+    history = [create_message("system", "You are a helpful agent."), create_message("user", "<task>demo</task>"), create_message("assistant", "plan")]
+
+    def simulate(mode: str):
+        traj = Trajectory() if mode == "incremental" else []
+        request_tokens, trim_seconds = [], []
+        prompt = "Start the subtask."
+        for step in range(num_actions):
+            st = time.perf_counter()
+            if mode != "untrimmed":
+                MemoryManager.trim_traj(traj, preserve_last=3)
+            trim_seconds.append(time.perf_counter() - st)
+            request_tokens.append(estimate_messages_tokens(history + traj) + estimate_messages_tokens([create_message("user", prompt)]))
+            traj.extend([create_message("user", prompt), create_message("assistant", actions[step])])
+            prompt = observations[step]
+        return traj, request_tokens, trim_seconds
+
+    results = {mode: simulate(mode) for mode in ("untrimmed", "full-walk", "incremental")}
+    assert [m.text for m in results["full-walk"][0]] == [m.text for m in results["incremental"][0]]
+    print(f"{num_actions} browser actions, ~{estimate_messages_tokens([create_message('user', observations[0])])} tokens per observation")
+    for mode, (_, request_tokens, trim_seconds) in results.items():
+        print(f"{mode:>11}: {sum(request_tokens):>9} request tokens in total, last request {request_tokens[-1]:>7} tokens, "
+              f"trim {sum(trim_seconds) / len(trim_seconds) * 1000:.3f} ms/call (max {max(trim_seconds) * 1000:.3f} ms)")
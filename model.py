@@ -1,13 +1,20 @@
 import os
+import json
+import time
 import yaml
 import httpx
 import base64
+import asyncio
+import hashlib
 import aiofiles
 import traceback
 from pathlib import Path
+from collections import deque, OrderedDict
 from dotenv import load_dotenv
 from openai import AsyncOpenAI
-from typing import AsyncGenerator, Union
+from typing import AsyncGenerator, Union, Dict, Tuple, Optional, List
+
+from utils import Message, estimate_tokens, estimate_messages_tokens, MESSAGE_TOKEN_OVERHEAD
 
 load_dotenv()
 
@@ -15,6 +22,192 @@ with open("config.yaml", "r") as f:
     raw_config = os.path.expandvars(f.read())
     config = yaml.safe_load(raw_config)
 LLM_CONFIG = config["llm"]
+CLIENT_CONFIG = config.get("llm_client") or {}
+CACHE_CONFIG = config.get("llm_cache") or {}
+CASSETTE_CONFIG = config.get("llm_cassette") or {}
+PROMPT_CACHE_CONFIG = config.get("prompt_cache") or {}
+HISTORY_BUDGET_CONFIG = config.get("history_budget") or {}
+
+
+def request_key(model: str, messages: list, temperature: Optional[float], max_tokens: Optional[int]) -> str:
+    """对模型名、消息、temperature 与 max_tokens 做规范化 JSON 序列化后取 SHA-256, 作为请求的内容指纹。"""
+    payload = json.dumps(
+        {"model": model, "messages": messages, "temperature": temperature, "max_tokens": max_tokens},
+        ensure_ascii=False, sort_keys=True, default=str
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    以请求内容哈希为键的磁盘响应缓存, 支持 TTL 过期与按条目数的 LRU 淘汰。
+    LRU 顺序在启动时按文件 mtime 建立一次, 之后在内存中维护, 写入时不再扫描目录; 文件读写经 asyncio.to_thread 执行, 不阻塞事件循环。
+    """
+
+    def __init__(self, cache_dir: Union[str, Path], ttl: Optional[float] = None, max_entries: int = 2000):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # 条目键 -> None, 最久未使用的在前
+        self._lru: OrderedDict[str, None] = OrderedDict()
+        entries = []
+        for path in self.cache_dir.glob("*.json"):
+            try:
+                entries.append((path.stat().st_mtime, path.stem))
+            except FileNotFoundError:
+                continue
+        for _, key in sorted(entries):
+            self._lru[key] = None
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.json"
+
+    def _read(self, key: str) -> Optional[dict]:
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            path.unlink(missing_ok=True)
+            return None
+
+        if self.ttl is not None and time.time() - entry.get("created", 0) > self.ttl:
+            path.unlink(missing_ok=True)
+            return None
+
+        # 刷新 mtime, 使重启后重建的 LRU 顺序与内存中的一致
+        os.utime(path)
+        return entry
+
+    def _write(self, key: str, content: str, usage: Optional[dict]) -> bool:
+        path = self._path(key)
+        tmp_path = path.with_suffix(".tmp")
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"created": time.time(), "content": content, "usage": usage or {}}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"[SYSTEM WARNING][CACHE] ⚠️ Failed to write cache entry {key}: {e}")
+            tmp_path.unlink(missing_ok=True)
+            return False
+        return True
+
+    def _remove(self, keys: List[str]):
+        for key in keys:
+            self._path(key).unlink(missing_ok=True)
+
+    def _touch(self, key: str):
+        self._lru[key] = None
+        self._lru.move_to_end(key)
+
+    async def get(self, key: str) -> Optional[dict]:
+        """命中时返回 {"content", "usage"} 并刷新 LRU 顺序; 过期或损坏的条目会被删除。"""
+        entry = await asyncio.to_thread(self._read, key)
+        if entry is None:
+            self._lru.pop(key, None)
+        else:
+            self._touch(key)
+        return entry
+
+    async def put(self, key: str, content: str, usage: Optional[dict] = None):
+        """原子写入一条缓存, 并在超出容量时淘汰最久未使用的条目。"""
+        if not await asyncio.to_thread(self._write, key, content, usage):
+            return
+        self._touch(key)
+        overflow = [self._lru.popitem(last=False)[0] for _ in range(len(self._lru) - self.max_entries)]
+        if overflow:
+            await asyncio.to_thread(self._remove, overflow)
+
+
+class CassetteMiss(LookupError):
+    """回放时找不到可用的录制响应; 不经 _handle_error 转为模型回复, 直接中止运行。"""
+
+
+class Cassette:
+    """
+    JSONL 录制/回放存储: record 模式追加每次请求与响应, replay 模式按请求指纹依序回放, 不访问网络。
+    指纹未命中时 (工具输出含随机路径、实时网页内容等) 按录制顺序回放同一调用点 (call_site) 的下一条记录;
+    fallback=false 或该调用点的记录已耗尽时抛出 CassetteMiss。
+    """
+
+    def __init__(self, path: Union[str, Path], mode: str, latency: float = 0.0, tokens_per_sec: Optional[float] = None, fallback: bool = True):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Cassette mode must be 'record' or 'replay', but received '{mode}'")
+        self.path = Path(path)
+        self.mode = mode
+        self.latency = latency or 0.0
+        self.tokens_per_sec = tokens_per_sec
+        self.fallback = fallback
+        self._entries: Dict[str, deque] = {}
+        # call_site -> 按录制顺序排列的记录, 指纹未命中时从中依序取用
+        self._by_call_site: Dict[str, deque] = {}
+        self.fallbacks = 0
+
+        if mode == "record":
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+        else:
+            self._load()
+
+    def _load(self):
+        """读取整个 cassette, 按请求指纹分组; 同一请求多次出现时按录制顺序回放。"""
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                entry["used"] = False
+                self._entries.setdefault(entry["key"], deque()).append(entry)
+                self._by_call_site.setdefault(entry.get("call_site", "default"), deque()).append(entry)
+
+    def record(self, key: str, request: dict, chunks: List[str], usage: Optional[dict], finish_reason: Optional[str], elapsed: float, call_site: str = "default"):
+        """追加一条请求/响应记录, chunks 保留流式输出的原始分片边界。"""
+        entry = {
+            "key": key,
+            "call_site": call_site,
+            "request": request,
+            "chunks": chunks,
+            "usage": usage or {},
+            "finish_reason": finish_reason,
+            "elapsed": round(elapsed, 4)
+        }
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def next(self, key: str, call_site: str = "default") -> dict:
+        """取出该指纹的下一条记录; 最后一条会被保留, 以便重复请求持续命中。未命中时见类说明。"""
+        entries = self._entries.get(key)
+        if entries:
+            entry = entries.popleft() if len(entries) > 1 else entries[0]
+            entry["used"] = True
+            return entry
+        if self.fallback:
+            queue = self._by_call_site.get(call_site) or deque()
+            while queue:
+                entry = queue.popleft()
+                if not entry["used"]:
+                    entry["used"] = True
+                    self.fallbacks += 1
+                    print(f"[SYSTEM WARNING][CASSETTE] Request {key[:12]} at call site '{call_site}' was not recorded, "
+                          f"replaying the next recorded '{call_site}' response instead ({self.fallbacks} fallbacks so far).")
+                    return entry
+        raise CassetteMiss(f"No recorded response in cassette {self.path} for request {key[:12]} at call site '{call_site}'.")
+
+    async def replay(self, entry: dict) -> AsyncGenerator[str, None]:
+        """按配置的首包延迟与 tokens/sec 模拟模型输出节奏, 逐片返回录制的分片。"""
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        for chunk in entry["chunks"]:
+            if self.tokens_per_sec:
+                await asyncio.sleep(max(1, len(chunk) // 4) / self.tokens_per_sec)
+            yield chunk
+
+
+class ContextWindowExceeded(ValueError):
+    """请求的估算 token 数超过模型配置的 context_window, 在发送前拒绝。"""
+
 
 class LLM:
     """封装模型调用与统计逻辑, 对外提供统一的文本/多模态生成接口。"""
@@ -23,47 +216,207 @@ class LLM:
     PROMPT_TOKENS = 0
     COMPLETION_TOKENS = 0
     MAX_TOKENS = 0
+    CACHE_HITS = 0
+    CACHE_MISSES = 0
+    SAVED_PROMPT_TOKENS = 0
+    # 服务端前缀缓存命中的 prompt token 数 (usage.prompt_tokens_details.cached_tokens)
+    CACHED_PROMPT_TOKENS = 0
+    SAVED_COMPLETION_TOKENS = 0
+    # 按调用点 (plan / react_step / reflect_check / summarize ...) 统计发送前估算的请求大小
+    CALL_SITE_TOKENS: Dict[str, Dict[str, int]] = {}
+
+    # 进程级注册表: 连接池按 base_url 共享, 客户端按 (base_url, api_key, model) 共享,
+    # LLM 实例按配置名共享, 切换模型时可以直接复用已建立的 TCP/TLS 连接。
+    _HTTP_CLIENTS: Dict[str, httpx.AsyncClient] = {}
+    _ASYNC_CLIENTS: Dict[Tuple[str, str, Optional[str]], AsyncOpenAI] = {}
+    _INSTANCES: Dict[str, "LLM"] = {}
+    _CACHE: Optional[ResponseCache] = None
+    _CASSETTE: Optional[Cassette] = None
 
     def __init__(self, model: str="Qwen2.5-VL-7B-Instruct"):
-        """根据配置文件创建异步 OpenAI 客户端, 并记录目标模型标识。"""
+        """根据配置文件获取共享的异步 OpenAI 客户端, 并记录目标模型标识。"""
         cfg = LLM_CONFIG.get(model)
         if cfg is None:
             raise ValueError(f"Model '{model}' not found in config.yaml")
-        self.async_client = AsyncOpenAI(
-            api_key=cfg["api_key"],
-            base_url=cfg["base_url"],
-            http_client=httpx.AsyncClient(verify=False),
-            timeout=180
-        )
+        self.async_client = self.get_async_client(cfg["base_url"], cfg["api_key"], cfg["model"])
         self.model = cfg["model"]
+        # 开启 prompt_cache 且该模型声明 cache_control: true 时, 在稳定前缀末尾添加 cache_control 断点
+        self.cache_control = bool(PROMPT_CACHE_CONFIG.get("enabled", False) and cfg.get("cache_control", False))
+        # 可选的上下文窗口 (token), 配置后估算超限的请求在发送前即返回错误
+        self.context_window: Optional[int] = cfg.get("context_window")
+        self.cache = self._get_cache()
+        self.cassette = self._get_cassette()
+
+    @classmethod
+    def _get_cache(cls) -> Optional[ResponseCache]:
+        """按 config.yaml 的 llm_cache 配置懒加载全局响应缓存, 未启用时返回 None。"""
+        if not CACHE_CONFIG.get("enabled", False):
+            return None
+        if cls._CACHE is None:
+            cls._CACHE = ResponseCache(
+                CACHE_CONFIG.get("cache_dir", ".cache/llm"),
+                ttl=CACHE_CONFIG.get("ttl"),
+                max_entries=CACHE_CONFIG.get("max_entries", 2000)
+            )
+        return cls._CACHE
+
+    @classmethod
+    def _get_cassette(cls) -> Optional[Cassette]:
+        """按 config.yaml 的 llm_cassette 配置懒加载全局录制/回放后端, 未启用时返回 None。"""
+        mode = CASSETTE_CONFIG.get("mode")
+        if not mode:
+            return None
+        if cls._CASSETTE is None:
+            cls._CASSETTE = Cassette(
+                CASSETTE_CONFIG.get("path", ".cache/cassette.jsonl"),
+                mode,
+                latency=CASSETTE_CONFIG.get("latency", 0.0),
+                tokens_per_sec=CASSETTE_CONFIG.get("tokens_per_sec"),
+                fallback=CASSETTE_CONFIG.get("fallback", True)
+            )
+        return cls._CASSETTE
+
+    @classmethod
+    def get(cls, model: str) -> "LLM":
+        """按配置名返回进程内共享的 LLM 实例, 规划/执行阶段来回切换模型时不再重复构造。"""
+        instance = cls._INSTANCES.get(model)
+        if instance is None:
+            instance = cls(model)
+            cls._INSTANCES[model] = instance
+        return instance
+
+    @classmethod
+    def get_async_client(cls, base_url: str, api_key: str, model: Optional[str] = None) -> AsyncOpenAI:
+        """返回 (base_url, api_key, model) 对应的共享 AsyncOpenAI 客户端, 底层连接池按 base_url 复用。"""
+        key = (base_url, api_key, model)
+        client = cls._ASYNC_CLIENTS.get(key)
+        if client is None:
+            client = AsyncOpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                http_client=cls._get_http_client(base_url),
+                timeout=CLIENT_CONFIG.get("timeout", 180)
+            )
+            cls._ASYNC_CLIENTS[key] = client
+        return client
+
+    @classmethod
+    def _get_http_client(cls, base_url: str) -> httpx.AsyncClient:
+        """按 base_url 创建/复用 httpx 连接池, keep-alive、HTTP/2 与连接上限均来自 config.yaml。"""
+        http_client = cls._HTTP_CLIENTS.get(base_url)
+        if http_client is not None:
+            return http_client
+
+        http2 = bool(CLIENT_CONFIG.get("http2", False))
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                print("[SYSTEM WARNING][CLIENT] ⚠️ http2 is enabled but the `h2` package is not installed, falling back to HTTP/1.1.")
+                http2 = False
+
+        http_client = httpx.AsyncClient(
+            verify=False,
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=CLIENT_CONFIG.get("max_connections", 100),
+                max_keepalive_connections=CLIENT_CONFIG.get("max_keepalive_connections", 20),
+                keepalive_expiry=CLIENT_CONFIG.get("keepalive_expiry", 60)
+            )
+        )
+        cls._HTTP_CLIENTS[base_url] = http_client
+        return http_client
+
+    @classmethod
+    async def aclose_all(cls):
+        """关闭所有共享连接池并清空注册表, 应在进程退出 (事件循环结束) 前调用。"""
+        http_clients = list(cls._HTTP_CLIENTS.values())
+        cls._HTTP_CLIENTS.clear()
+        cls._ASYNC_CLIENTS.clear()
+        cls._INSTANCES.clear()
+        for http_client in http_clients:
+            try:
+                await http_client.aclose()
+            except Exception as e:
+                print(f"[SYSTEM WARNING][CLIENT] ⚠️ Failed to close http client: {e}")
 
     @staticmethod
-    def _accumulate_usage(usage):
-        """聚合单次请求的 token 统计, 用于后续生成运行报告。"""
+    def _usage_to_dict(usage) -> dict:
+        """将 SDK 返回的 usage 对象或字典统一转换为只含 token 计数的字典。"""
         get = (lambda k, default=0:
                usage.get(k, default) if isinstance(usage, dict)
                else getattr(usage, k, default))
-        prompt_tokens = get("prompt_tokens", 0)
-        completion_tokens = get("completion_tokens", 0)
-        LLM.PROMPT_TOKENS += int(prompt_tokens or 0)
-        LLM.COMPLETION_TOKENS += int(completion_tokens or 0)
-        LLM.MAX_TOKENS = max(
-            LLM.MAX_TOKENS,
-            int(prompt_tokens or 0) + int(completion_tokens or 0)
-        )
+        details = get("prompt_tokens_details", None)
+        if details is not None:
+            cached = details.get("cached_tokens", 0) if isinstance(details, dict) else getattr(details, "cached_tokens", 0)
+        else:
+            # 已转换过的字典 (缓存/cassette) 直接带 cached_tokens; Anthropic 兼容网关以 cache_read_input_tokens 返回
+            cached = get("cached_tokens", 0) or get("cache_read_input_tokens", 0)
+        return {
+            "prompt_tokens": int(get("prompt_tokens", 0) or 0),
+            "completion_tokens": int(get("completion_tokens", 0) or 0),
+            "cached_tokens": int(cached or 0)
+        }
+
+    @staticmethod
+    def _accumulate_cache_hit(usage: Optional[dict]):
+        """记录一次缓存命中, 并把原始请求的 token 计入节省量。"""
+        LLM.CACHE_HITS += 1
+        usage = usage or {}
+        LLM.SAVED_PROMPT_TOKENS += int(usage.get("prompt_tokens", 0) or 0)
+        LLM.SAVED_COMPLETION_TOKENS += int(usage.get("completion_tokens", 0) or 0)
+
+    @staticmethod
+    def _replay_chunks(content: str, chunk_size: int):
+        """将缓存的完整回复切分为若干片段, 模拟流式输出。"""
+        for i in range(0, len(content), max(1, chunk_size)):
+            yield content[i:i + chunk_size]
+
+    @staticmethod
+    def _accumulate_usage(usage):
+        """聚合单次请求的 token 统计, 用于后续生成运行报告。"""
+        usage = LLM._usage_to_dict(usage)
+        prompt_tokens = usage["prompt_tokens"]
+        completion_tokens = usage["completion_tokens"]
+        LLM.PROMPT_TOKENS += prompt_tokens
+        LLM.COMPLETION_TOKENS += completion_tokens
+        LLM.CACHED_PROMPT_TOKENS += usage["cached_tokens"]
+        LLM.MAX_TOKENS = max(LLM.MAX_TOKENS, prompt_tokens + completion_tokens)
 
     async def async_generate(
             self,
             prompt: str,
             image_path: Union[str, Path, None] = None,
-            history: list[dict] = None,
-            max_tokens: Union[int, None] = 32768
+            history: list[Union[Message, dict]] = None,
+            max_tokens: Union[int, None] = 32768,
+            call_site: str = "default"
     ) -> str:
         """发送同步式对话请求, 返回一次性生成的文本内容。"""
-        LLM.NUM_CALLS += 1
         try:
+            self._preflight(prompt, history, call_site)
             messages = await self.prepare_messages(prompt, image_path, history)
 
+            key = None
+            if self.cache is not None or self.cassette is not None:
+                key = request_key(self.model, messages, None, max_tokens)
+
+            if self.cassette is not None and self.cassette.mode == "replay":
+                entry = self.cassette.next(key, call_site)
+                LLM.NUM_CALLS += 1
+                self._accumulate_usage(entry["usage"])
+                return "".join([chunk async for chunk in self.cassette.replay(entry)])
+
+            # 录制时绕过缓存读取, 保证 cassette 中记录的是真实的模型响应与耗时。
+            if self.cache is not None and self.cassette is None:
+                cached = await self.cache.get(key)
+                if cached is not None:
+                    self._accumulate_cache_hit(cached.get("usage"))
+                    return cached["content"]
+                LLM.CACHE_MISSES += 1
+
+            # 缓存命中只计入 CACHE_HITS, NUM_CALLS 只统计真正发给模型 (或由 cassette 回放) 的请求
+            LLM.NUM_CALLS += 1
+            st_time = time.time()
             resp = await self.async_client.chat.completions.create(
                 model=self.model,
                 messages=messages,
@@ -91,6 +444,14 @@ class LLM:
                 print("[SYSTEM WARNING][SYNC] ⚠️ Response has no content (may contain only tool/function signals).")
                 return self._handle_error(RuntimeError("Empty content in first choice."))
 
+            usage_dict = self._usage_to_dict(usage) if usage else None
+            if self.cache is not None:
+                await self.cache.put(key, content, usage_dict)
+            if self.cassette is not None:
+                self.cassette.record(
+                    key, {"model": self.model, "messages": messages, "max_tokens": max_tokens, "stream": False},
+                    [content], usage_dict, getattr(c0, "finish_reason", None), time.time() - st_time, call_site
+                )
             return content
 
         except Exception as e:
@@ -100,15 +461,41 @@ class LLM:
             self,
             prompt: str,
             image_path: Union[str, Path, None] = None,
-            history: list[dict] = None,
+            history: list[Union[Message, dict]] = None,
             max_tokens: Union[int, None] = 32768,
-            temperature: float = 1.0
+            temperature: float = 1.0,
+            call_site: str = "default"
     ) -> AsyncGenerator[str, None]:
         """以流式方式返回模型增量输出, 适合实时展示。"""
-        LLM.NUM_CALLS += 1
         try:
+            self._preflight(prompt, history, call_site)
             messages = await self.prepare_messages(prompt, image_path, history)
 
+            key = None
+            if self.cache is not None or self.cassette is not None:
+                key = request_key(self.model, messages, temperature, max_tokens)
+
+            if self.cassette is not None and self.cassette.mode == "replay":
+                entry = self.cassette.next(key, call_site)
+                LLM.NUM_CALLS += 1
+                self._accumulate_usage(entry["usage"])
+                async for piece in self.cassette.replay(entry):
+                    yield piece
+                return
+
+            # 录制时绕过缓存读取, 保证 cassette 中记录的是真实的模型响应与耗时。
+            if self.cache is not None and self.cassette is None:
+                cached = await self.cache.get(key)
+                if cached is not None:
+                    self._accumulate_cache_hit(cached.get("usage"))
+                    for piece in self._replay_chunks(cached["content"], CACHE_CONFIG.get("replay_chunk_size", 64)):
+                        yield piece
+                    return
+                LLM.CACHE_MISSES += 1
+
+            # 缓存命中只计入 CACHE_HITS, NUM_CALLS 只统计真正发给模型 (或由 cassette 回放) 的请求
+            LLM.NUM_CALLS += 1
+            st_time = time.time()
             stream = await self.async_client.chat.completions.create(
                 model=self.model,
                 messages=messages,
@@ -119,13 +506,17 @@ class LLM:
             )
 
             saw_explicit_finish = False
+            last_finish_reason = None
             usage_accumulated = False
+            usage_dict = None
+            content_parts = []
 
             async for chunk in stream:
                 usage = getattr(chunk, "usage", None)
                 if usage and not usage_accumulated:
                     self._accumulate_usage(usage)
                     usage_accumulated = True
+                    usage_dict = self._usage_to_dict(usage)
 
                 choices = getattr(chunk, "choices", None) or []
                 if not choices:
@@ -136,6 +527,7 @@ class LLM:
                 finish_reason = getattr(c0, "finish_reason", None)
                 if finish_reason is not None:
                     saw_explicit_finish = True
+                    last_finish_reason = finish_reason
                     self._log_finish_reason("STREAM", finish_reason)
 
                 delta = getattr(c0, "delta", None)
@@ -145,25 +537,55 @@ class LLM:
                     if maybe_usage:
                         self._accumulate_usage(maybe_usage)
                         usage_accumulated = True
+                        usage_dict = self._usage_to_dict(maybe_usage)
 
                 content = getattr(delta, "content", None) if delta else None
                 if content is not None:
+                    content_parts.append(content)
                     yield content
 
             if not saw_explicit_finish:
                 print("[SYSTEM INFO][STREAM] ℹ️ Stream ended without explicit finish_reason (likely normal).")
 
+            if self.cache is not None and content_parts:
+                await self.cache.put(key, "".join(content_parts), usage_dict)
+            if self.cassette is not None:
+                self.cassette.record(
+                    key, {"model": self.model, "messages": messages, "temperature": temperature, "max_tokens": max_tokens, "stream": True},
+                    content_parts, usage_dict, last_finish_reason, time.time() - st_time, call_site
+                )
+
         except Exception as e:
             yield self._handle_error(e)
 
+    def _preflight(self, prompt: str, history: Optional[list], call_site: str) -> int:
+        """
+        发送前估算请求大小 (历史消息的估算值按消息缓存, 不会每次重新计算), 按调用点累计到 CALL_SITE_TOKENS;
+        超过 context_window 时抛出 ContextWindowExceeded, 由调用方的 _handle_error 转为错误信息。图片不计入。
+        """
+        estimated = estimate_messages_tokens(history or []) + estimate_tokens(prompt) + MESSAGE_TOKEN_OVERHEAD
+        stat = LLM.CALL_SITE_TOKENS.setdefault(call_site, {"calls": 0, "estimated_prompt_tokens": 0, "max_estimated_prompt_tokens": 0})
+        stat["calls"] += 1
+        stat["estimated_prompt_tokens"] += estimated
+        stat["max_estimated_prompt_tokens"] = max(stat["max_estimated_prompt_tokens"], estimated)
+        if self.context_window and estimated > self.context_window:
+            raise ContextWindowExceeded(
+                f"estimated request size {estimated} tokens exceeds the context window ({self.context_window}) of {self.model} at call site '{call_site}'"
+            )
+        return estimated
+
     async def prepare_messages(
         self,
         prompt: str,
         image_path: Union[str, Path, None],
-        history: list[dict] = None
+        history: list[Union[Message, dict]] = None
     ) -> list[dict]:
-        """将历史上下文与当前指令组装成 OpenAI Chat 请求格式。"""
-        messages = history.copy() if history else []
+        """将历史上下文与当前指令组装成 OpenAI Chat 请求格式。history 中的 Message 在此处才转换为 wire 格式, 也接受现成的 dict。"""
+        messages = [m.to_dict() if isinstance(m, Message) else m for m in history] if history else []
+        if self.cache_control and messages:
+            # 系统提示词与历史末尾是相邻请求共享的前缀, 分别设置断点; 复制被标记的消息, 不修改调用方的历史。
+            for i in {0, len(messages) - 1}:
+                messages[i] = self._with_cache_control(messages[i])
 
         if image_path:
             base64_image = await self.image_to_base64(image_path)
@@ -179,8 +601,20 @@ class LLM:
         )
         return messages
 
+    @staticmethod
+    def _with_cache_control(message: dict) -> dict:
+        """返回在最后一个内容块上附加 ephemeral cache_control 的消息副本。"""
+        content = message.get("content")
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}]
+        if not content:
+            return message
+        return {**message, "content": [*content[:-1], {**content[-1], "cache_control": {"type": "ephemeral"}}]}
+
     def _handle_error(self, e: Exception) -> str:
-        """统一的异常处理, 返回带错误类型的字符串以供上游日志记录。"""
+        """统一的异常处理, 返回带错误类型的字符串以供上游日志记录。回放缺失 (CassetteMiss) 直接抛出, 避免回放悄然偏离录制。"""
+        if isinstance(e, CassetteMiss):
+            raise e
         print(f"==========Error: {e}==========")
         print(traceback.format_exc())
         print(f"==========Model: {self.model}==========")
@@ -215,10 +649,8 @@ class LLM:
 if __name__ == "__main__":
     print(LLM_CONFIG)
 
-    import asyncio
-
     async def test():
-        llm = LLM("gemini-2.5-flash")
+        llm = LLM.get("gemini-2.5-flash")
 
         history = [
             {"role": "user", "content": [{"type": "text", "text": "You are Long Aotian from Class 3-1"}]},
@@ -229,5 +661,6 @@ if __name__ == "__main__":
             print(chunk, end="")
 
         print("\n[USAGE] prompt =", LLM.PROMPT_TOKENS, "completion =", LLM.COMPLETION_TOKENS)
+        await LLM.aclose_all()
 
     asyncio.run(test())
@@ -1,6 +1,8 @@
 from dataclasses import dataclass, field, asdict
 from typing import Dict, List, Optional
 
+from utils import Message
+
 @dataclass
 class Reflection:
     analysis: str = ""
@@ -17,8 +19,8 @@ class SubTask:
     goal: str
     index: int = -1   # `-1` indicates not executed
     finish: bool = False
-    trajectory: List[dict] = field(default_factory=list)
-    reflect_trajectory: List[dict] = field(default_factory=list)
+    trajectory: List[Message] = field(default_factory=list)
+    reflect_trajectory: List[Message] = field(default_factory=list)
     reflection: Reflection = field(default_factory=Reflection)
     try_times: int = 0
 
@@ -33,8 +35,8 @@ class SubTask:
             goal=data.get("goal", ""),
             index=data.get("index", -1),
             finish=data.get("finish", False),
-            trajectory=data.get("trajectory", []),
-            reflect_trajectory=data.get("reflect_trajectory", []),
+            trajectory=[Message.from_dict(m) for m in data.get("trajectory", [])],
+            reflect_trajectory=[Message.from_dict(m) for m in data.get("reflect_trajectory", [])],
             reflection=reflection,
             try_times=data.get("try_times", 0),
         )
@@ -59,6 +61,8 @@ class ToolStat:
     calls: int = 0
     modified: int = 0
     errors: int = 0
+    # 工具上报的累计指标, 如浏览器工具的 settle_wait_seconds (动作后等待页面稳定的总秒数)
+    metrics: Dict[str, float] = field(default_factory=dict)
 
     @classmethod
     def from_dict(cls, data: dict):
@@ -66,6 +70,7 @@ class ToolStat:
             calls=data.get("calls", 0),
             modified=data.get("modified", 0),
             errors=data.get("errors", 0),
+            metrics=data.get("metrics", {}),
         )
 
 @dataclass
@@ -109,6 +114,12 @@ class Monitor:
         if self._exist_tool(name):
             self.tool_call[name].errors += 1
 
+    def add_tool_metrics(self, name: str, metrics: Dict[str, float]):
+        if self._exist_tool(name):
+            stat = self.tool_call[name].metrics
+            for key, value in metrics.items():
+                stat[key] = round(stat.get(key, 0) + value, 3)
+
     def add_done_subtask(self, subtask: SubTask):
         assert subtask.index != -1
         self.done_subtasks.append(subtask)
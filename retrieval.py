@@ -0,0 +1,124 @@
+import re
+import json
+import math
+import hashlib
+import traceback
+from pathlib import Path
+from collections import Counter
+from typing import Dict, List, Tuple, Any, Union
+
+# 英文/数字按词切分并转小写, 中日韩字符逐字切分, 无需额外的分词依赖。
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+|[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]")
+_DOC_SEP = "\x1f"
+
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+    """
+    程序性记忆 (应用 -> 条目 -> 内容) 上的 BM25 索引。每个条目是一篇文档,
+    按内容哈希增量更新, 以 JSON 持久化在记忆文件旁边, 用于为当前任务/子任务挑选最相关的 top-k 条目。
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        # doc_id -> {"app", "item", "hash", "len", "tf": {term: count}}
+        self.docs: Dict[str, Dict[str, Any]] = {}
+        # term -> {doc_id: tf}, 由 docs 派生, 不落盘
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.total_len = 0
+
+    @staticmethod
+    def _doc_id(app: str, item: str) -> str:
+        return f"{app}{_DOC_SEP}{item}"
+
+    @staticmethod
+    def _content_hash(app: str, item: str, detail: Any) -> str:
+        payload = json.dumps([app, item, detail], ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _add(self, doc_id: str, doc: Dict[str, Any]):
+        self.docs[doc_id] = doc
+        self.total_len += doc["len"]
+        for term, tf in doc["tf"].items():
+            self.postings.setdefault(term, {})[doc_id] = tf
+
+    def _remove(self, doc_id: str):
+        doc = self.docs.pop(doc_id)
+        self.total_len -= doc["len"]
+        for term in doc["tf"]:
+            posting = self.postings.get(term)
+            if posting is not None:
+                posting.pop(doc_id, None)
+                if not posting:
+                    del self.postings[term]
+
+    def sync(self, app_dict: Dict[str, Any]) -> bool:
+        """与记忆字典对齐: 只重新分词新增或内容变化的条目, 删除已不存在的条目。返回索引是否发生变化。"""
+        seen = set()
+        changed = False
+        for app, items in app_dict.items():
+            if not isinstance(items, dict):
+                items = {"": items}
+            for item, detail in items.items():
+                doc_id = self._doc_id(app, item)
+                seen.add(doc_id)
+                content_hash = self._content_hash(app, item, detail)
+                old = self.docs.get(doc_id)
+                if old is not None and old["hash"] == content_hash:
+                    continue
+                if old is not None:
+                    self._remove(doc_id)
+                # 应用名与条目名比正文更能代表主题, 各计入两次
+                terms = tokenize(f"{app} {item} {app} {item} {detail if isinstance(detail, str) else json.dumps(detail, ensure_ascii=False)}")
+                self._add(doc_id, {"app": app, "item": item, "hash": content_hash, "len": len(terms), "tf": dict(Counter(terms))})
+                changed = True
+        for doc_id in [doc_id for doc_id in self.docs if doc_id not in seen]:
+            self._remove(doc_id)
+            changed = True
+        return changed
+
+    def search(self, query: str, top_k: int) -> List[Tuple[float, str, str]]:
+        """返回与查询最相关的至多 top_k 个 (score, app, item), 只包含得分大于 0 的条目。"""
+        n = len(self.docs)
+        if n == 0 or top_k <= 0:
+            return []
+        avg_len = self.total_len / n or 1.0
+        scores: Dict[str, float] = {}
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            for doc_id, tf in posting.items():
+                norm = tf + self.k1 * (1 - self.b + self.b * self.docs[doc_id]["len"] / avg_len)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / norm
+        ranked = sorted(scores.items(), key=lambda x: x[1], reverse=True)[:top_k]
+        return [(score, self.docs[doc_id]["app"], self.docs[doc_id]["item"]) for doc_id, score in ranked]
+
+    def save(self, path: Union[str, Path]):
+        try:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump({"k1": self.k1, "b": self.b, "docs": self.docs}, f, ensure_ascii=False)
+        except Exception as e:
+            print(f"Failed to save retrieval index to {path}: {e}")
+            traceback.print_exc()
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "BM25Index":
+        """读取持久化的索引, 文件不存在或损坏时返回空索引 (随后由 sync 重建)。"""
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            index = cls(data.get("k1", 1.5), data.get("b", 0.75))
+            for doc_id, doc in data.get("docs", {}).items():
+                index._add(doc_id, doc)
+            return index
+        except FileNotFoundError:
+            return cls()
+        except Exception as e:
+            print(f"Failed to load retrieval index from {path}, rebuilding it: {e}")
+            return cls()
@@ -4,6 +4,8 @@ import asyncio
 import argparse
 import subprocess
 
+from model import LLM
+from tool import ToolRegistry
 from agent import MUSE
 from prompt.system_prompt import MUSE_sys_prompt
 
@@ -65,6 +67,10 @@ async def main():
     parser.add_argument("--mode", type=str, help="Training mode", default="test")
     parser.add_argument("--round", type=int, help="Training round", default=1)
     parser.add_argument("--llm", type=str, help="Base LLM", default="gemini-2.5-flash")
+    parser.add_argument("--persistent_python", action="store_true", help="Keep a warm Python kernel across python tool calls")
+    parser.add_argument("--memory_retrieval_top_k", type=int, help="Only inject the top-k most relevant application guide entries into the system prompt", default=None)
+    parser.add_argument("--reflect_workers", type=int, help="Run up to this many reflection check steps concurrently", default=1)
+    parser.add_argument("--observation_token_budget", type=int, help="Prune this agent's browser accessibility-tree observations above this many tokens", default=None)
     args = parser.parse_args()
 
     mode = args.mode
@@ -85,6 +91,10 @@ async def main():
             task_round=args.round,
             use_memory=True,
             update_memory=True,
+            persistent_python=args.persistent_python,
+            memory_retrieval_top_k=args.memory_retrieval_top_k,
+            reflect_workers=args.reflect_workers,
+            observation_token_budget=args.observation_token_budget,
             # lang="zh"
             # env_feedback_func=get_tac_evaluation,
             # env_feedback_args={"task_name": args.task_name, "agent_name": agent_name, "mode": args.mode, "round": args.round}
@@ -105,6 +115,10 @@ async def main():
             task_round=args.round,
             use_memory=False,
             update_memory=False,
+            persistent_python=args.persistent_python,
+            memory_retrieval_top_k=args.memory_retrieval_top_k,
+            reflect_workers=args.reflect_workers,
+            observation_token_budget=args.observation_token_budget,
             # lang="zh"
         )
         agent.logger.log_task(args.task, subtitle="STARTING······", title="Task")
@@ -119,5 +133,9 @@ async def main():
     with open(agent._get_output_dir() / "eval_log.txt", mode="w") as f:
         f.write(eval_log)
 
+    # 关闭共享的 LLM 连接池与工具模块的共享资源 (浏览器池及其临时 profile), 避免事件循环结束时残留。
+    await ToolRegistry.aclose_all()
+    await LLM.aclose_all()
+
 if __name__ == "__main__":
     asyncio.run(main())
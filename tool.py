@@ -3,12 +3,20 @@ import inspect
 import json
 import os
 import re
+import sys
+from contextvars import ContextVar
 from typing import Callable, List, Union, get_origin, get_args, Dict, Any
 
+# 当前正在执行的智能体/任务标识, 由 BaseAgent.run 设置; 有状态的工具 (如浏览器) 据此为每个智能体分配独立资源。
+current_agent_key: ContextVar[str] = ContextVar("current_agent_key", default="default")
+# 当前智能体的工具选项 (如 observation_token_budget), 同样由 BaseAgent.run 设置, 值为 None 的选项使用 config.yaml 中的默认值。
+current_agent_options: ContextVar[dict] = ContextVar("current_agent_options", default={})
+
 
 class ToolRegistry:
     def __init__(self):
         self.tools = {}
+        self.modules = []
 
     def register_tool(self, tool_name: str, tool_func: Callable):
         self.tools[tool_name] = tool_func
@@ -19,6 +27,7 @@ class ToolRegistry:
     def load_module_tools(self, module_name: str):
         try:
             module = importlib.import_module(f"toolbox.{module_name}")
+            self.modules.append(module)
 
             for attr_name in dir(module):
                 attr = getattr(module, attr_name)
@@ -41,6 +50,39 @@ class ToolRegistry:
         for module_name in modules:
             self.load_module_tools(module_name)
 
+    async def _call_agent_hook(self, hook_name: str, agent_key: str):
+        """调用各工具模块可选的 `hook_name(agent_key)` 协程钩子, 单个模块出错不影响其他模块。"""
+        for module in self.modules:
+            hook = getattr(module, hook_name, None)
+            if hook is None:
+                continue
+            try:
+                await hook(agent_key)
+            except Exception as e:
+                print(f"Error calling '{hook_name}' of '{module.__name__}' for '{agent_key}': {e}")
+
+    async def release_resources(self, agent_key: str):
+        """调用各工具模块的 `_release_agent_resources` 钩子, 释放该智能体占用的资源。"""
+        await self._call_agent_hook("_release_agent_resources", agent_key)
+
+    async def reset_observations(self, agent_key: str):
+        """调用各工具模块的 `_reset_agent_observations` 钩子, 使下一次观测不依赖模型已看不到的上下文 (如 AX-tree diff 基准)。"""
+        await self._call_agent_hook("_reset_agent_observations", agent_key)
+
+    @staticmethod
+    async def aclose_all():
+        """调用所有已加载工具模块可选的 `_shutdown_tool_module()` 钩子 (如关闭浏览器池), 应与 LLM.aclose_all 一起在进程退出前调用。"""
+        for name, module in list(sys.modules.items()):
+            if not name.startswith("toolbox.") or module is None:
+                continue
+            hook = getattr(module, "_shutdown_tool_module", None)
+            if hook is None:
+                continue
+            try:
+                await hook()
+            except Exception as e:
+                print(f"Error calling '_shutdown_tool_module' of '{name}': {e}")
+
 
 def generate_tool_schema(func: Callable, enhance_des: str | None = None) -> str:
 
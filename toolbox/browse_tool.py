@@ -1,37 +1,86 @@
 
-import asyncio
+from typing import List
+from contextlib import asynccontextmanager
 
-from browser import BrowserUse
+from model import config
+from tool import current_agent_key, current_agent_options
+from browser import BrowserUse, BrowserPool
 
-browser = BrowserUse()
+# Each agent (see tool.current_agent_key) gets its own browser with an isolated profile from the pool.
+pool = BrowserPool(**(config.get("browser_pool") or {}), browser_kwargs=config.get("browser") or {})
 
 browser_axtree_wrapper = "<webpage accessibility tree>\n{axtree}\n</webpage accessibility tree>"
 browser_state_wrapper = "<webpage interactive elements>\n{state}\n</webpage interactive elements>"
 tool_result_prompt = "Performed browser action: {tool_result}\nThe updated browser page status is as follows:\n" + browser_axtree_wrapper + "\n" + browser_state_wrapper + "\n"
 
-async def _get_browser_observation(wait_seconds: int=1):
-    await asyncio.sleep(wait_seconds)
-    axtree = await browser.get_axtree()
+async def _get_browser() -> BrowserUse:
+    browser = await pool.acquire(current_agent_key.get())
+    # 智能体自己的观测预算覆盖 config.yaml 中所有浏览器共享的默认值
+    budget = current_agent_options.get().get("observation_token_budget")
+    if budget is not None:
+        browser.observation_token_budget = budget
+    return browser
+
+@asynccontextmanager
+async def _locked_browser():
+    """The agent's browser, held exclusively so that concurrent tool calls (parallel reflection) do not interleave an action with another call's observation."""
+    agent_key = current_agent_key.get()
+    browser = await _get_browser()
+    try:
+        async with browser.lock:
+            yield browser
+    finally:
+        # A long action counts as use: the idle timeout starts when the call ends, not when it started.
+        pool.touch(agent_key)
+
+async def _release_agent_resources(agent_key: str):
+    await pool.release(agent_key)
+
+async def _shutdown_tool_module():
+    await pool.close_all()
+
+async def _reset_agent_observations(agent_key: str):
+    browser = pool.peek(agent_key)
+    if browser is not None:
+        browser.reset_observation_baseline()
+
+async def _get_browser_observation(browser: BrowserUse, force_full: bool=False, token_budget: int=None):
+    # Wait until the page settles (navigation done, network idle, DOM quiet) instead of a fixed sleep.
+    waited = await browser.wait_for_settle()
+    # Read the AX tree before the browser-use state summary: the summary injects highlight overlays and index labels
+    # into the DOM, which would otherwise show up in some AX snapshots (and as spurious lines in diff mode).
+    axtree = await browser.observe_axtree(force_full=force_full, token_budget=token_budget)
     state = await browser.get_browser_state()
-    return axtree, state
+    return axtree, state, waited
 
-async def browser_extract_content_by_vision(query: str):
+async def _observation_chunk(browser: BrowserUse, result, **kwargs):
+    axtree, state, waited = await _get_browser_observation(browser, **kwargs)
+    return {
+        "data": tool_result_prompt.format(axtree=axtree, state=state, tool_result=str(result)),
+        "instruction": "",
+        "metrics": {"settle_wait_seconds": waited}
+    }
+
+async def browser_extract_content_by_vision(query: str, index: int = None, region: List[int] = None):
     """
     Following the instructions, use the Visual Language model to extract the specified content from the browser page screenshot.
     Note:
         The VL model is subject to error. You should primarily use the `accessibility tree` and `interactive elements` returned by each browser tool to understand the browser state.
         This visual tool is intended only as a last resort.
+        Asking about a single element or region gives the model a sharper, cheaper image than the whole viewport.
 
     Args:
         query: Query to the VL model to get the browser page content.
+        index: Optional index of an interactive element, the screenshot is cropped to that element.
+        region: Optional viewport region [x, y, width, height] in CSS pixels, the screenshot is cropped to it.
     """
-    await browser.get_browser_state()
-    result = await browser.extract_content_by_vision(query)
-    axtree, state = await _get_browser_observation()
-    yield {
-        "data": tool_result_prompt.format(axtree=axtree, state=state, tool_result=str(result)),
-        "instruction": ""
-    }
+    async with _locked_browser() as browser:
+        if not browser.browser_session:
+            chunk = {"data": 'Error: No browser session active, please use go to a url', "instruction": ""}
+        else:
+            result = await browser.extract_content_by_vision(query, index=index, region=region)
+            chunk = await _observation_chunk(browser, result)
+    yield chunk
 
 async def browser_go_to_url( url: str, new_tab: bool = False):
     """
@@ -41,13 +90,10 @@ async def browser_go_to_url( url: str, new_tab: bool = False):
         url: The URL of the target website.
         new_tab: Whether to open in a new tab (default False).
     """
-    result = await browser.go_to_url(url, new_tab=new_tab)
-    axtree, state = await _get_browser_observation()
-
-    yield {
-        "data": tool_result_prompt.format(axtree=axtree, state=state, tool_result=str(result)),
-        "instruction": ""
-    }
+    async with _locked_browser() as browser:
+        result = await browser.go_to_url(url, new_tab=new_tab)
+        chunk = await _observation_chunk(browser, result)
+    yield chunk
 
 async def browser_click(index: int):
     """
@@ -56,15 +102,40 @@ async def browser_click(index: int):
     Args:
         index: The index number of the target element.
     """
-    result = await browser.click_element_by_index(index)
-    axtree, state = await _get_browser_observation(2)
+    async with _locked_browser() as browser:
+        result = await browser.click_element_by_index(index)
+        chunk = await _observation_chunk(browser, result)
+    yield chunk
+
+async def browser_batch_actions(actions: List[dict]):
+    """
+    Execute a sequence of browser actions in one call, then return the updated page status once at the end.
+    Use it for predictable multi-step interactions on the current page, e.g. fill several form fields and then click submit.
+    Each action is an object with an "action" name plus the same parameters as the corresponding single-action tool:
+        {"action": "input_text", "index": 3, "text": "Alice"}
+        {"action": "click_element_by_index", "index": 7}
+        {"action": "send_keys", "keys": "Enter"}
+        {"action": "select_dropdown_option", "index": 5, "text": "Engineering"}
+        {"action": "scroll", "down": true, "num_pages": 0.5}
+        {"action": "go_to_url", "url": "https://example.com"}, {"action": "go_back"}, {"action": "wait", "seconds": 1}, {"action": "switch_tab", "tab_index": 1}
+    Element indices refer to the current interactive elements. Put actions that navigate or re-render the page last, because indices may change afterwards.
+    Execution stops at the first failed action.
 
-    yield {
-        "data": tool_result_prompt.format(axtree=axtree, state=state, tool_result=str(result)),
-        "instruction": ""
-    }
+    Args:
+        actions: The list of actions to execute in order.
+    """
+    async with _locked_browser() as browser:
+        results = await browser.execute_batch(actions)
+        result = "\n".join(
+            f"Step {i + 1} ({step.get('action') if isinstance(step, dict) else step!r}): {res}"
+            for i, (step, res) in enumerate(zip(actions, results))
+        )
+        if len(results) < len(actions):
+            result += f"\nStopped after step {len(results)}, the remaining {len(actions) - len(results)} action(s) were not executed."
+        chunk = await _observation_chunk(browser, result)
+    yield chunk
 
-async def browser_wait_and_get_update(seconds: int = 3):
+async def browser_wait_and_get_update(seconds: int = 3, token_budget: int = None):
     """
     Wait for a set amount of time, then retrieve the latest browser accessibility tree and interactive elements.
     Note: You can set a very short wait time (1 second) to immediately retrieve the current browser accessibility tree and interactive elements.
@@ -76,17 +147,14 @@ async def browser_wait_and_get_update(seconds: int = 3):
 
     Args:
         seconds: The number of seconds to wait, the default is 3 seconds.
+        token_budget: Optional token budget for the returned accessibility tree. Large pages are pruned to fit (elided parts are marked); a larger value shows more of the page.
     """
-    result = await browser.wait(seconds)
-    axtree, state = await _get_browser_observation()
-    browser_status_text = tool_result_prompt.format(axtree=axtree, state=state, tool_result=str(result))
-    with open("/workspace/latest_browser_status.txt", "w") as f:
-        f.write(browser_status_text)
-
-    yield {
-        "data": browser_status_text,
-        "instruction": ""
-    }
+    async with _locked_browser() as browser:
+        result = await browser.wait(seconds)
+        chunk = await _observation_chunk(browser, result, force_full=True, token_budget=token_budget)
+        with open("/workspace/latest_browser_status.txt", "w") as f:
+            f.write(chunk["data"])
+    yield chunk
 
 async def browser_input_text(index: int, text: str):
     """
@@ -96,13 +164,10 @@ async def browser_input_text(index: int, text: str):
         index: The index number of the target element.
         text: The text to be entered.
     """
-    result = await browser.input_text(index, text)
-    axtree, state = await _get_browser_observation()
-
-    yield {
-        "data": tool_result_prompt.format(axtree=axtree, state=state, tool_result=str(result)),
-        "instruction": ""
-    }
+    async with _locked_browser() as browser:
+        result = await browser.input_text(index, text)
+        chunk = await _observation_chunk(browser, result)
+    yield chunk
 
 async def browser_send_keys(keys: str):
     """
@@ -111,25 +176,19 @@ async def browser_send_keys(keys: str):
     Args:
         keys: The key to sent, such as "Enter", "Control+A", etc.
     """
-    result = await browser.send_keys(keys)
-    axtree, state = await _get_browser_observation()
-
-    yield {
-        "data": tool_result_prompt.format(axtree=axtree, state=state, tool_result=str(result)),
-        "instruction": ""
-    }
+    async with _locked_browser() as browser:
+        result = await browser.send_keys(keys)
+        chunk = await _observation_chunk(browser, result)
+    yield chunk
 
 async def browser_go_back():
     """
     Trigger "back" of the current browser tab.
     """
-    result = await browser.go_back()
-    axtree, state = await _get_browser_observation()
-
-    yield {
-        "data": tool_result_prompt.format(axtree=axtree, state=state, tool_result=str(result)),
-        "instruction": ""
-    }
+    async with _locked_browser() as browser:
+        result = await browser.go_back()
+        chunk = await _observation_chunk(browser, result)
+    yield chunk
 
 async def browser_scroll(down: bool=True, num_pages: float=0.5, index: int=None):
     """
@@ -141,25 +200,19 @@ async def browser_scroll(down: bool=True, num_pages: float=0.5, index: int=None)
         num_pages: Number of pages to scroll (0.5 = half page, 1.0 = one page, etc.)
         index: Optional element index to find scroll container for
     """
-    result = await browser.scroll(down, num_pages, index)
-    axtree, state = await _get_browser_observation()
-
-    yield {
-        "data": tool_result_prompt.format(axtree=axtree, state=state, tool_result=str(result)),
-        "instruction": ""
-    }
+    async with _locked_browser() as browser:
+        result = await browser.scroll(down, num_pages, index)
+        chunk = await _observation_chunk(browser, result)
+    yield chunk
 
 async def browser_list_tabs():
     """
     Get a list of all currently open tabs in the browser.
     """
-    result = await browser.list_tabs()
-    axtree, state = await _get_browser_observation()
-
-    yield {
-        "data": tool_result_prompt.format(axtree=axtree, state=state, tool_result=str(result)),
-        "instruction": ""
-    }
+    async with _locked_browser() as browser:
+        result = await browser.list_tabs()
+        chunk = await _observation_chunk(browser, result)
+    yield chunk
 
 async def browser_switch_tab(tab_index: int):
     """
@@ -168,13 +221,10 @@ async def browser_switch_tab(tab_index: int):
     Args:
         tab_index: The index number of the target tab.
     """
-    result = await browser.switch_tab(tab_index)
-    axtree, state = await _get_browser_observation()
-
-    yield {
-        "data": tool_result_prompt.format(axtree=axtree, state=state, tool_result=str(result)),
-        "instruction": ""
-    }
+    async with _locked_browser() as browser:
+        result = await browser.switch_tab(tab_index)
+        chunk = await _observation_chunk(browser, result)
+    yield chunk
 
 async def browser_close_tab(tab_index: int):
     """
@@ -183,10 +233,7 @@ async def browser_close_tab(tab_index: int):
     Args:
         tab_index: The index number of the target tab.
     """
-    result = await browser.close_tab(tab_index)
-    axtree, state = await _get_browser_observation()
-
-    yield {
-        "data": tool_result_prompt.format(axtree=axtree, state=state, tool_result=str(result)),
-        "instruction": ""
-    }
\ No newline at end of file
+    async with _locked_browser() as browser:
+        result = await browser.close_tab(tab_index)
+        chunk = await _observation_chunk(browser, result)
+    yield chunk
\ No newline at end of file
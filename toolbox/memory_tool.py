@@ -3,12 +3,35 @@ import traceback
 from pathlib import Path
 from typing import List, Dict, Optional, Union
 
+from memory_manager import MemoryManager
+
 memory_dir = "memory"
 path = Path(memory_dir) / "procedural_memory.json"
 application_guide: Dict[str, Dict[str, str]] = {}
+# (mtime_ns, size, MemoryManager.APP_MEMORY_VERSION) of the last load, the guide is only re-read when it changes.
+_guide_signature: Optional[tuple] = None
+# Signature recorded while the guide file is missing, so "File not found" is printed only once.
+_GUIDE_MISSING: tuple = ()
 
 def _update_application_guide() -> None:
-    global application_guide
+    global application_guide, _guide_signature
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        if _guide_signature != _GUIDE_MISSING:
+            print(f"File not found: {path}")
+            _guide_signature = _GUIDE_MISSING
+        return
+    except Exception as e:
+        print(f"Unexpected error reading {path}: {e}")
+        traceback.print_exc()
+        return
+
+    signature = (stat.st_mtime_ns, stat.st_size, MemoryManager.APP_MEMORY_VERSION)
+    if signature == _guide_signature:
+        return
+    _guide_signature = signature
+
     try:
         with open(path, "r", encoding="utf-8") as f:
             text = f.read()
@@ -1,8 +1,10 @@
 
-import subprocess
 import json
-import traceback
 import shlex
+import asyncio
+import traceback
+
+from utils import stream_subprocess, HeadTailBuffer
 
 # ========================================================================
 # Config
@@ -34,11 +36,6 @@ MAX_OUTPUT_LENGTH = 65536
 # ========================================================================
 # Helpers
 # ========================================================================
-def _truncate_with_status(text: str, max_len: int) -> tuple[str, bool]:
-    if len(text) > max_len:
-        return text[:max_len], True
-    return text, False
-
 def _analyze_command(command: str) -> tuple[bool, str | None, int, str]:
     """
     Analyze raw command string:
@@ -92,6 +89,7 @@ async def run_cmd(command: str):
         command: shell command string.
     """
     inner_result = {}
+    outputs = {"stdout": HeadTailBuffer(MAX_OUTPUT_LENGTH), "stderr": HeadTailBuffer(MAX_OUTPUT_LENGTH)}
 
     try:
         is_safe, warning_msg, timeout_value, final_command = _analyze_command(command)
@@ -103,38 +101,41 @@ async def run_cmd(command: str):
             yield {"data": json.dumps(inner_result, ensure_ascii=False, indent=2), "instruction": ""}
             return
 
-        # Run command inside bash
-        proc = subprocess.run(
+        # Run command inside bash without blocking the event loop.
+        # Lines are streamed to the operator as progress chunks, while the tool result keeps a bounded head+tail.
+        returncode = None
+        async for name, line in stream_subprocess(
             final_command,
-            shell=True,
-            executable="/bin/bash",
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
+            timeout=timeout_value,
             cwd="/workspace",
-            timeout=timeout_value
-        )
-
-        stdout, stdout_truncated = _truncate_with_status(proc.stdout.strip(), MAX_OUTPUT_LENGTH)
-        stderr, stderr_truncated = _truncate_with_status(proc.stderr.strip(), MAX_OUTPUT_LENGTH)
+            shell=True,
+            executable="/bin/bash"
+        ):
+            if name == "returncode":
+                returncode = line
+                continue
+            outputs[name].append(line)
+            yield {"data": line, "instruction": "", "progress": True}
 
         inner_result = {
             "execution_status": STATUS_EXECUTED,
             "command_result": {
                 "executed_command": final_command,
-                "returncode": proc.returncode,
-                "stdout_truncated": stdout_truncated,
-                "stderr_truncated": stderr_truncated,
+                "returncode": returncode,
+                "stdout_truncated": outputs["stdout"].truncated,
+                "stderr_truncated": outputs["stderr"].truncated,
                 "warning": warning_msg
             },
-            "stdout": stdout,
-            "stderr": stderr
+            "stdout": outputs["stdout"].getvalue().strip(),
+            "stderr": outputs["stderr"].getvalue().strip()
         }
 
-    except subprocess.TimeoutExpired:
+    except asyncio.TimeoutError:
         inner_result = {
             "execution_status": STATUS_FAILURE_TIMEOUT,
-            "stderr": f"⏰ Command execution timed out (>{timeout_value} seconds). Process was terminated."
+            "stdout": outputs["stdout"].getvalue().strip(),
+            "stderr": (outputs["stderr"].getvalue().strip() + "\n"
+                       f"⏰ Command execution timed out (>{timeout_value} seconds). Process was terminated.").strip()
         }
 
     except FileNotFoundError:
@@ -1,55 +1,79 @@
 import imghdr
 import os
 import base64
+import asyncio
+import hashlib
 from pathlib import Path
-from openai import OpenAI
+from typing import List
+from collections import OrderedDict
 
-client = OpenAI(
-    api_key=os.getenv("API_KEY"),
-    base_url=os.getenv("BASE_URL")
-)
+from model import LLM
+from utils import downscale_image
 
-async def extract_image_content_by_gpt4o(
-    image_path: str,
-    query: str
-):
-    """
-    Use vlm `gpt-4o` to recognize or understand local images.
+# ========================================================================
+# Config
+# ========================================================================
+VLM_MODEL = "gpt-4o"
+MAX_IMAGE_EDGE = 2048        # larger images are downscaled before upload (needs Pillow)
+JPEG_QUALITY = 85
+RESULT_CACHE_SIZE = 256      # (image content hash, query) -> answer
+ENCODED_CACHE_SIZE = 64      # (path, mtime, size) -> encoded image
+BATCH_CONCURRENCY = 4
 
-    Args:
-        image_path: Local image path.
-        query: Query to the gpt-4o to get the image content.
-    """
+# Answers keyed by (content hash, query), encoded images keyed by file identity; both LRU.
+_result_cache: OrderedDict[tuple, str] = OrderedDict()
+_encoded_cache: OrderedDict[tuple, tuple] = OrderedDict()
+
+# ========================================================================
+# Helpers
+# ========================================================================
+def _lru_put(cache: OrderedDict, key: tuple, value, max_size: int):
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > max_size:
+        cache.popitem(last=False)
+
+def _encode_image(path: Path, img_type: str) -> tuple[str, str, str]:
+    """Read, downscale and base64-encode an image. Returns (content hash, base64 data, image type)."""
+    image_bytes = path.read_bytes()
+    digest = hashlib.sha256(image_bytes).hexdigest()
+    image_bytes, img_type = downscale_image(image_bytes, img_type, MAX_IMAGE_EDGE, JPEG_QUALITY)
+    return digest, base64.b64encode(image_bytes).decode("utf-8"), img_type
+
+async def _ask_vlm(image_path: str, query: str) -> str:
+    """Answer `query` about one local image, returning the answer or an `Error: ...` message."""
     path = Path(image_path)
 
     if not path.exists():
-        yield {
-            "data": f"Error: File not found at path `{image_path}`.",
-            "instruction": ""
-        }
-        return
+        return f"Error: File not found at path `{image_path}`."
 
     img_type = imghdr.what(path)
     if img_type is None:
-        yield {
-            "data": f"Error: The file at `{image_path}` is not a valid image.",
-            "instruction": ""
-        }
-        return
+        return f"Error: The file at `{image_path}` is not a valid image."
 
     try:
-        image_bytes = path.read_bytes()
-        base64_image = base64.b64encode(image_bytes).decode("utf-8")
+        stat = path.stat()
+        file_key = (str(path.resolve()), stat.st_mtime_ns, stat.st_size)
+        encoded = _encoded_cache.get(file_key)
+        if encoded is None:
+            # File IO, hashing and resizing run in a worker thread to keep the event loop free.
+            encoded = await asyncio.to_thread(_encode_image, path, img_type)
+            _lru_put(_encoded_cache, file_key, encoded, ENCODED_CACHE_SIZE)
+        else:
+            _encoded_cache.move_to_end(file_key)
+        digest, base64_image, img_type = encoded
     except Exception as e:
-        yield {
-            "data": f"Error: Failed to read/encode the image `{image_path}`. Details: {e}",
-            "instruction": ""
-        }
-        return
+        return f"Error: Failed to read/encode the image `{image_path}`. Details: {e}"
+
+    result_key = (digest, query)
+    if result_key in _result_cache:
+        _result_cache.move_to_end(result_key)
+        return _result_cache[result_key]
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
+        client = LLM.get_async_client(os.getenv("BASE_URL"), os.getenv("API_KEY"))
+        response = await client.chat.completions.create(
+            model=VLM_MODEL,
             messages=[
                 {
                     "role": "user",
@@ -67,14 +91,54 @@ async def extract_image_content_by_gpt4o(
             temperature=0.2,
             max_tokens=1024
         )
-
-        result = response.choices[0].message.content
-        yield {
-            "data": result,
-            "instruction": ""
-        }
     except Exception as e:
-        yield {
-            "data": f"Error: gpt-4o request failed. Details: {e}",
-            "instruction": ""
-        }
\ No newline at end of file
+        return f"Error: gpt-4o request failed. Details: {e}"
+
+    result = response.choices[0].message.content
+    _lru_put(_result_cache, result_key, result, RESULT_CACHE_SIZE)
+    return result
+
+# ========================================================================
+# Main
+# ========================================================================
+async def extract_image_content_by_gpt4o(
+    image_path: str,
+    query: str
+):
+    """
+    Use vlm `gpt-4o` to recognize or understand local images.
+
+    Args:
+        image_path: Local image path.
+        query: Query to the gpt-4o to get the image content.
+    """
+    yield {
+        "data": await _ask_vlm(image_path, query),
+        "instruction": ""
+    }
+
+async def batch_extract_image_content_by_gpt4o(requests: List[dict]):
+    """
+    Use vlm `gpt-4o` to answer several (image, query) pairs concurrently, e.g. when scanning a folder of receipts or invoices.
+    Each request is an object like {"image_path": "/workspace/receipts/1.jpg", "query": "What is the total amount?"}.
+    The answers are returned in the same order as the requests.
+
+    Args:
+        requests: The list of {"image_path", "query"} objects.
+    """
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def ask(request: dict) -> str:
+        if not isinstance(request, dict) or "image_path" not in request or "query" not in request:
+            return f"Error: Invalid request {request!r}, expected an object with `image_path` and `query`."
+        async with semaphore:
+            return await _ask_vlm(str(request["image_path"]), str(request["query"]))
+
+    answers = await asyncio.gather(*(ask(request) for request in requests))
+    yield {
+        "data": "\n\n".join(
+            f"[{i + 1}] {request.get('image_path') if isinstance(request, dict) else request}\n{answer}"
+            for i, (request, answer) in enumerate(zip(requests, answers))
+        ),
+        "instruction": ""
+    }
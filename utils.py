@@ -1,11 +1,18 @@
 
+import io
+import os
 import re
+import codecs
+import signal
+import sys
+import asyncio
 import logging
 import dirtyjson
-from typing import Dict, Any, List, Tuple, Optional
+from collections import deque
+from typing import Dict, Any, List, Tuple, Optional, Union, AsyncGenerator
 
 
-def pretty_print_trajectory(messages: List[dict], show_full_content: bool = False, print_to_terminal: bool = True):
+def pretty_print_trajectory(messages: List["Message"], show_full_content: bool = False, print_to_terminal: bool = True):
     output_lines = []
 
     def colored(text, color):
@@ -22,8 +29,9 @@ def pretty_print_trajectory(messages: List[dict], show_full_content: bool = Fals
     output_lines.append("")
 
     for idx, msg in enumerate(messages):
-        role = msg.get("role", "")
-        if role not in ("system", "user", "assistant"):
+        msg = Message.from_dict(msg)
+        role = msg.role
+        if role not in Message.ROLES:
             continue
         role_disp = colored(f"{'=' * 50} {role.upper()} MESSAGE {'=' * 50}", role)
         line_header = f"{idx + 1:02d}. | {role_disp}"
@@ -33,7 +41,7 @@ def pretty_print_trajectory(messages: List[dict], show_full_content: bool = Fals
             print(line_header)
         output_lines.append(plain_line_header)
 
-        content = msg["content"][0]["text"]
+        content = msg.text
         if isinstance(content, str) and not show_full_content and len(content) > 500:
             preview = content[:250] + "\n ... [Collapsed] ... \n" + content[-250:]
             if print_to_terminal:
@@ -67,6 +75,21 @@ def dict_to_outline_str(d: dict, indent: int = 2) -> str:
             lines.append(f"{k}: {v}")
     return "\n".join(lines)
 
+_CJK_PATTERN = re.compile(r"[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]")
+
+# Per-message framing (role, separators) added on top of the text estimate.
+MESSAGE_TOKEN_OVERHEAD = 4
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheap local token estimate without a tokenizer: CJK characters count as one token each,
+    everything else as roughly four characters per token.
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
 def deep_update(d: dict, u: dict):
     for k, v in u.items():
         if isinstance(v, dict) and k in d and isinstance(d[k], dict):
@@ -74,32 +97,239 @@ def deep_update(d: dict, u: dict):
         else:
             d[k] = v
 
-def create_message(role: str, text: str) -> dict:
-    allowed_roles = {"system", "user", "assistant"}
-    if role not in allowed_roles:
-        raise ValueError(f"role must be one of {allowed_roles}，but received '{role}'")
-    return {"role": role, "content": [{"type": "text", "text": text}]}
+class Message:
+    """
+    Compact chat message used inside the agent (history, trajectories, monitor). Only `LLM.prepare_messages`
+    converts it to the OpenAI wire format. Messages are treated as immutable and shared between lists,
+    replace them (see MemoryManager.trim_traj) instead of editing `text` in place.
+    """
+    __slots__ = ("role", "text", "_tokens")
+    ROLES = ("system", "user", "assistant")
+
+    def __init__(self, role: str, text: str):
+        self.role = sys.intern(role)
+        self.text = text
+        self._tokens = None
+
+    @property
+    def tokens(self) -> int:
+        """Estimated token count (see estimate_tokens), computed once per message."""
+        if self._tokens is None:
+            self._tokens = estimate_tokens(self.text) + MESSAGE_TOKEN_OVERHEAD
+        return self._tokens
+
+    def to_dict(self) -> dict:
+        return {"role": self.role, "content": [{"type": "text", "text": self.text}]}
+
+    @classmethod
+    def from_dict(cls, data: Union[dict, "Message"]) -> "Message":
+        """Accept an OpenAI style dict (string or text-part content) or an existing Message."""
+        if isinstance(data, cls):
+            return data
+        content = data.get("content")
+        if isinstance(content, list):
+            content = "".join(part.get("text", "") for part in content if isinstance(part, dict))
+        return cls(data.get("role", "user"), content or "")
+
+    def __deepcopy__(self, memo):
+        # 消息不可变, 共享即可 (dataclasses.asdict 等会对其 deepcopy)
+        return self
+
+    def __eq__(self, other):
+        return isinstance(other, Message) and self.role == other.role and self.text == other.text
+
+    __hash__ = None
+
+    def __repr__(self):
+        preview = self.text if len(self.text) <= 60 else self.text[:57] + "..."
+        return f"Message({self.role!r}, {preview!r})"
+
+def estimate_messages_tokens(messages: List[Union[Message, dict]]) -> int:
+    """Estimated prompt tokens of a message list, using each Message's cached estimate."""
+    return sum(m.tokens if isinstance(m, Message) else Message.from_dict(m).tokens for m in messages)
+
+def create_message(role: str, text: str) -> Message:
+    if role not in Message.ROLES:
+        raise ValueError(f"role must be one of {set(Message.ROLES)}，but received '{role}'")
+    return Message(role, text)
+
+def message_to_json(obj):
+    """`default` hook for json.dump, serializes Message objects (e.g. in monitor trajectories)."""
+    if isinstance(obj, Message):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+class Trajectory(list):
+    """
+    Message list that remembers how far it has been trimmed: messages before `trimmed_until`
+    were already processed by MemoryManager.trim_traj and are skipped by later calls.
+    """
+
+    def __init__(self, messages=()):
+        super().__init__(messages)
+        self.trimmed_until = 0
+
+    @property
+    def tokens(self) -> int:
+        return estimate_messages_tokens(self)
+
+def kill_process_group(proc: asyncio.subprocess.Process):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+class HeadTailBuffer:
+    """
+    Bounded text accumulator: keeps the first and last `max_len // 2` characters of everything
+    appended and counts what was dropped in between, so chatty processes never grow memory.
+    """
+
+    def __init__(self, max_len: int):
+        self.head_len = max_len // 2
+        self.tail_len = max_len - self.head_len
+        self.head = ""
+        self.tail = deque()
+        self.tail_size = 0
+        self.dropped = 0
+
+    def append(self, text: str):
+        if len(self.head) < self.head_len:
+            take = self.head_len - len(self.head)
+            self.head += text[:take]
+            text = text[take:]
+        if not text:
+            return
+        self.tail.append(text)
+        self.tail_size += len(text)
+        while self.tail_size - len(self.tail[0]) >= self.tail_len:
+            self.tail_size -= len(self.tail[0])
+            self.dropped += len(self.tail.popleft())
+
+    @property
+    def truncated(self) -> bool:
+        return self.dropped > 0 or self.tail_size > self.tail_len
+
+    def getvalue(self) -> str:
+        tail = "".join(self.tail)
+        if len(tail) > self.tail_len:
+            self.dropped += len(tail) - self.tail_len
+            tail = tail[-self.tail_len:]
+            self.tail = deque([tail])
+            self.tail_size = len(tail)
+        if self.dropped:
+            return f"{self.head}\n... [{self.dropped} characters truncated] ...\n{tail}"
+        return self.head + tail
+
+async def _pump_lines(stream: asyncio.StreamReader, name: str, queue: asyncio.Queue, max_line: int = 8192):
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    pending = ""
+    while True:
+        data = await stream.read(4096)
+        if not data:
+            break
+        pending += decoder.decode(data)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            await queue.put((name, line + "\n"))
+        if len(pending) >= max_line:
+            await queue.put((name, pending))
+            pending = ""
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        await queue.put((name, pending))
+    await queue.put((name, None))
+
+async def stream_subprocess(
+        cmd: Union[str, List[str]],
+        timeout: float,
+        cwd: Optional[str] = None,
+        shell: bool = False,
+        executable: Optional[str] = None,
+        max_queued_lines: int = 1024
+) -> AsyncGenerator[Tuple[str, Union[str, int]], None]:
+    """
+    Run a command without blocking the event loop, yielding ("stdout" | "stderr", line) as lines arrive
+    and finally ("returncode", code).
+    The child is started in its own session, so on timeout (measured over the whole run) or cancellation
+    the whole process group is killed before the exception propagates.
+    At most `max_queued_lines` lines are buffered: when the consumer falls behind, the readers stop
+    draining the pipes and the child blocks on write, so memory stays bounded for noisy commands.
+    """
+    if shell:
+        proc = await asyncio.create_subprocess_shell(
+            cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            cwd=cwd, executable=executable, start_new_session=True
+        )
+    else:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            cwd=cwd, start_new_session=True
+        )
+
+    queue: asyncio.Queue = asyncio.Queue(maxsize=max_queued_lines)
+    pumps = [
+        asyncio.create_task(_pump_lines(proc.stdout, "stdout", queue)),
+        asyncio.create_task(_pump_lines(proc.stderr, "stderr", queue))
+    ]
+    deadline = asyncio.get_running_loop().time() + timeout
+    try:
+        open_streams = len(pumps)
+        while open_streams:
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            name, line = await asyncio.wait_for(queue.get(), remaining)
+            if line is None:
+                open_streams -= 1
+                continue
+            yield name, line
+        remaining = max(deadline - asyncio.get_running_loop().time(), 0)
+        returncode = await asyncio.wait_for(proc.wait(), remaining)
+    except BaseException:
+        kill_process_group(proc)
+        for pump in pumps:
+            pump.cancel()
+        # 读取端可能因队列已满而暂停, 管道收不到 EOF 时 proc.wait() 不会返回; 丢弃剩余输出直到管道关闭。
+        await proc.communicate()
+        raise
+    yield "returncode", returncode
+
+def downscale_image(data: bytes, fmt: str, max_edge: Optional[int], quality: int = 80) -> Tuple[bytes, str]:
+    """
+    Shrink an image so that its longest edge is at most `max_edge` pixels, re-encoding it as JPEG.
+    Returns (bytes, format). Pillow is optional: without it, or if the image is already small enough,
+    the input is returned unchanged.
+    """
+    if not max_edge:
+        return data, fmt
+    try:
+        from PIL import Image
+    except ImportError:
+        return data, fmt
+    try:
+        image = Image.open(io.BytesIO(data))
+        if max(image.size) <= max_edge:
+            return data, fmt
+        image.thumbnail((max_edge, max_edge))
+        buffer = io.BytesIO()
+        image.convert("RGB").save(buffer, format="JPEG", quality=quality)
+        return buffer.getvalue(), "jpeg"
+    except Exception:
+        return data, fmt
+
+_PYTHON_CODE_PATTERN = re.compile(r"(<code>)(.*?)(</code>)", re.DOTALL | re.IGNORECASE)
+_ACCESSIBILITY_TREE_PATTERN = re.compile(r"(<webpage accessibility tree>)(.*?)(</webpage accessibility tree>)", re.DOTALL | re.IGNORECASE)
+_BROWSER_STATE_PATTERN = re.compile(r"(<webpage interactive elements>)(.*?)(</webpage interactive elements>)", re.DOTALL | re.IGNORECASE)
 
 def remove_python_code_in_the_history(text: str) -> str:
-    pattern = re.compile(
-        r"(<code>)(.*?)(</code>)",
-        re.DOTALL | re.IGNORECASE
-    )
-    return pattern.sub(r"\1[SYSTEM INFO: History python code removed for brevity]\3", text)
+    return _PYTHON_CODE_PATTERN.sub(r"\1[SYSTEM INFO: History python code removed for brevity]\3", text)
 
 def remove_accessibility_tree_in_the_history(text: str) -> str:
-    pattern = re.compile(
-        r"(<webpage accessibility tree>)(.*?)(</webpage accessibility tree>)",
-        re.DOTALL | re.IGNORECASE
-    )
-    return pattern.sub(r"\1[SYSTEM INFO: History accessibility tree removed for brevity]\3", text)
+    return _ACCESSIBILITY_TREE_PATTERN.sub(r"\1[SYSTEM INFO: History accessibility tree removed for brevity]\3", text)
 
 def remove_browser_state_in_the_history(text: str) -> str:
-    pattern = re.compile(
-        r"(<webpage interactive elements>)(.*?)(</webpage interactive elements>)",
-        re.DOTALL | re.IGNORECASE
-    )
-    return pattern.sub(r"\1[SYSTEM INFO: History interactive elements removed for brevity]\3", text)
+    return _BROWSER_STATE_PATTERN.sub(r"\1[SYSTEM INFO: History interactive elements removed for brevity]\3", text)
 
 def extract_json_codeblock(md_text: str, debug: bool = False) -> Tuple[Dict[str, Any], Optional[str]]:
     match = re.search(r"```json[^\n]*\r?\n(.*?)\r?\n?```", md_text, re.DOTALL | re.IGNORECASE)